@@ -0,0 +1,153 @@
+import io
+from typing import NamedTuple, Optional
+
+# lxml parses a good deal faster, the standard library parser is used when it is not installed
+try:
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+ParseError = ET.ParseError
+
+# board_game_description.full_description holds at most 8000 characters
+DESCRIPTION_LENGTH = 8000
+
+BOARD_GAME_COLUMNS = (
+    'id', 'name', 'year_published', 'min_players', 'max_players', 'age', 'average_weight', 'playing_time',
+    'min_playing_time', 'max_playing_time', 'thumbnail', 'image', 'sub_domain', 'average', 'bayes_average', 'users_rated',
+)
+
+
+class GameRecord(NamedTuple):
+    # Everything the pipeline uses from one <boardgame>, with numbers already converted
+    id: int
+    name: Optional[str]
+    year_published: Optional[int]
+    min_players: Optional[int]
+    max_players: Optional[int]
+    age: Optional[int]
+    playing_time: Optional[int]
+    min_playing_time: Optional[int]
+    max_playing_time: Optional[int]
+    average_weight: Optional[float]
+    average: Optional[float]
+    bayes_average: Optional[float]
+    users_rated: Optional[int]
+    thumbnail: Optional[str]
+    image: Optional[str]
+    sub_domain: Optional[str]
+    full_description: Optional[str]
+    publishers: tuple
+    honors: tuple
+    mechanics: tuple
+    categories: tuple
+
+    def board_game_row(self):
+        # The record as parameters for the board_game table
+        return {column: getattr(self, column) for column in BOARD_GAME_COLUMNS}
+
+
+def to_int(text):
+    try:
+        return int(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_float(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_description(text):
+    return text[:DESCRIPTION_LENGTH] if text else None
+
+
+def to_text(text):
+    return text
+
+
+# Where each field sits below a <boardgame> element, as the path of tags leading to it, and how to convert it.
+# Only the first element on a path is used, the same as element.find() did
+SCALAR_FIELDS = {
+    ('yearpublished',): ('year_published', to_int),
+    ('minplayers',): ('min_players', to_int),
+    ('maxplayers',): ('max_players', to_int),
+    ('age',): ('age', to_int),
+    ('playingtime',): ('playing_time', to_int),
+    ('minplaytime',): ('min_playing_time', to_int),
+    ('maxplaytime',): ('max_playing_time', to_int),
+    ('description',): ('full_description', to_description),
+    ('thumbnail',): ('thumbnail', to_text),
+    ('image',): ('image', to_text),
+    ('boardgamesubdomain',): ('sub_domain', to_text),
+    ('statistics', 'ratings', 'average'): ('average', to_float),
+    ('statistics', 'ratings', 'bayesaverage'): ('bayes_average', to_float),
+    ('statistics', 'ratings', 'usersrated'): ('users_rated', to_int),
+    ('statistics', 'ratings', 'averageweight'): ('average_weight', to_float),
+}
+
+# Tags that can appear any number of times, every one of them is collected into the record field
+LIST_FIELDS = {
+    'boardgamepublisher': 'publishers',
+    'boardgamehonor': 'honors',
+    'boardgamemechanic': 'mechanics',
+    'boardgamecategory': 'categories',
+}
+
+
+def parse_games(source, keep_xml=False):
+    # Walk an API response once and yield (game id, GameRecord, xml) for every <boardgame> in it.
+    # A game is cleared as soon as it has been read, so memory stays flat no matter how many games a response holds.
+    # xml is the game on its own, for the response cache, and is None unless keep_xml is set
+    root = None
+    fields = None
+    path = []
+
+    for event, element in ET.iterparse(io.BytesIO(source), events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            if fields is not None:
+                path.append(element.tag)
+            elif element.tag == 'boardgame':
+                fields = {field: [] for field in LIST_FIELDS.values()}
+            continue
+
+        if fields is None:
+            continue
+
+        if not path:
+            # This is the end of the <boardgame> element itself. The API answers an id it has no game for with
+            # <boardgame><error message="Item not found"/></boardgame>, sometimes without an objectid, those are
+            # left out so the id counts as not fetched
+            object_id = element.get('objectid') or ''
+            if 'error' not in fields and object_id.isdigit():
+                game_id = int(object_id)
+                xml = ET.tostring(element) if keep_xml else None
+                yield game_id, make_record(game_id, fields), xml
+            fields = None
+            root.clear()
+            continue
+
+        key = tuple(path)
+        path.pop()
+        if key in SCALAR_FIELDS:
+            field, convert = SCALAR_FIELDS[key]
+            if field not in fields:
+                fields[field] = convert(element.text)
+        elif len(key) == 1:
+            if key[0] in LIST_FIELDS:
+                fields[LIST_FIELDS[key[0]]].append(element.text)
+            elif key[0] == 'name' and element.get('primary') == 'true' and 'name' not in fields:
+                fields['name'] = element.text
+            elif key[0] == 'error':
+                fields['error'] = element.get('message')
+
+
+def make_record(game_id, fields):
+    values = {field: fields.get(field) for field in GameRecord._fields[1:]}
+    values.update((field, tuple(fields[field])) for field in LIST_FIELDS.values())
+    return GameRecord(game_id, **values)
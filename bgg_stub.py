@@ -0,0 +1,126 @@
+import random
+import threading
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+
+# Stand-in for the BoardGameGeek XML API, for benchmarks. Every game is generated from its id,
+# so the same catalog produces the same responses on every run and on every commit
+
+MECHANICS = [f"Mechanic {number}" for number in range(190)]
+CATEGORIES = [f"Category {number}" for number in range(85)]
+PUBLISHERS = [f"Publisher {number}" for number in range(12000)]
+HONORS = [f"{year} Golden Geek Award Nominee {number}" for year in range(2000, 2025) for number in range(40)]
+SUBDOMAINS = ['Strategy Games', 'Family Games', 'Thematic Games', 'Party Games', 'Abstract Games', 'Wargames']
+# What the API answers for an id it has no game for
+MISSING_XML = '<boardgame><error message="Item not found"/></boardgame>'
+WORDS = "the players build trade explore cards dice tiles worker placement victory points round board &amp; engine".split()
+
+
+def game_xml(game_id):
+    rng = random.Random(game_id)
+    min_players = rng.randint(1, 4)
+    min_time = rng.choice([15, 20, 30, 45, 60, 90])
+    description = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(40, 400)))
+
+    parts = [
+        f'<boardgame objectid="{game_id}">',
+        f'<yearpublished>{rng.randint(1950, 2025)}</yearpublished>',
+        f'<minplayers>{min_players}</minplayers>',
+        f'<maxplayers>{min_players + rng.randint(0, 6)}</maxplayers>',
+        f'<playingtime>{min_time * 2}</playingtime>',
+        f'<minplaytime>{min_time}</minplaytime>',
+        f'<maxplaytime>{min_time * 2}</maxplaytime>',
+        f'<age>{rng.choice([6, 8, 10, 12, 14])}</age>',
+        f'<name primary="true" sortindex="1">Game {game_id}</name>',
+        f'<name sortindex="1">Spiel {game_id}</name>',
+        f'<description>{description}</description>',
+        f'<thumbnail>https://cf.geekdo-images.com/thumb/pic{game_id}.jpg</thumbnail>',
+        f'<image>https://cf.geekdo-images.com/original/pic{game_id}.jpg</image>',
+    ]
+    for tag, names, low, high in [
+        ('boardgamepublisher', PUBLISHERS, 1, 4),
+        ('boardgamehonor', HONORS, 0, 3),
+        ('boardgamemechanic', MECHANICS, 1, 6),
+        ('boardgamecategory', CATEGORIES, 1, 4),
+    ]:
+        for number in rng.sample(range(len(names)), rng.randint(low, high)):
+            parts.append(f'<{tag} objectid="{number}">{escape(names[number])}</{tag}>')
+    parts.append(f'<boardgamesubdomain objectid="1">{rng.choice(SUBDOMAINS)}</boardgamesubdomain>')
+
+    average = rng.uniform(4, 9)
+    parts.append(
+        '<statistics page="1"><ratings>'
+        f'<usersrated>{rng.randint(30, 100000)}</usersrated>'
+        f'<average>{average:.5f}</average>'
+        f'<bayesaverage>{average * 0.8:.5f}</bayesaverage>'
+        f'<averageweight>{rng.uniform(1, 5):.4f}</averageweight>'
+        '</ratings></statistics>'
+    )
+    parts.append('</boardgame>')
+    return ''.join(parts)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # The server's settings live on self.server: latency, error_rate, throttle_rate, queued_rate, retry_after,
+    # and missing_ids, the ids that are answered the way the API answers an id it has no game for
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            roll = server.random.random()
+
+        if server.latency:
+            sleep(server.latency)
+
+        if roll < server.throttle_rate:
+            return self.send_empty(429, {'Retry-After': str(server.retry_after)})
+        roll -= server.throttle_rate
+        if roll < server.queued_rate:
+            return self.send_empty(202)
+        roll -= server.queued_rate
+        if roll < server.error_rate:
+            return self.send_empty(500)
+
+        path = self.path.split('?')[0]
+        if not path.startswith('/boardgame/'):
+            return self.send_empty(404)
+        ids = [int(game_id) for game_id in path[len('/boardgame/'):].split(',') if game_id]
+
+        body = ('<boardgames termsofuse="https://boardgamegeek.com/xmlapi/termsofuse">'
+                + ''.join(MISSING_XML if game_id in server.missing_ids else game_xml(game_id) for game_id in ids)
+                + '</boardgames>').encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, status, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+def start_stub(latency=0.0, error_rate=0.0, throttle_rate=0.0, queued_rate=0.0, retry_after=1, seed=0, port=0):
+    # Serve on a background thread and return the server, its URL is f"http://127.0.0.1:{server.server_port}"
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.error_rate = error_rate
+    server.throttle_rate = throttle_rate
+    server.queued_rate = queued_rate
+    server.retry_after = retry_after
+    server.random = random.Random(seed)
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.missing_ids = set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,164 @@
+import os
+import importlib.util
+import pandas as pd
+from sqlalchemy import Float, Integer, String, Text
+from sqlalchemy.sql import text
+
+# Flat, pre-aggregated copies of the normalized tables for the Tableau dashboard. A dashboard filter
+# becomes an index scan of one table instead of a join of board_game, game_rank and four junction tables
+
+# (lookup table, junction table, junction column, column of the list in board_game_flat)
+LISTS = [
+    ('mechanics', 'board_game_has_mechanics', 'mechanic_id', 'mechanics'),
+    ('categories', 'board_game_has_categories', 'category_id', 'categories'),
+    ('publishers', 'board_game_has_publishers', 'publisher_id', 'publishers'),
+]
+
+# Top games per mechanic and per category: (lookup table, name of the export, column of the mechanic or category)
+RANKINGS = [
+    ('mechanics', 'mechanic_top_games', 'mechanic'),
+    ('categories', 'category_top_games', 'category'),
+]
+
+# BGG weights run from 1 to 5
+WEIGHT_BINS = [0, 1.8, 2.6, 3.4, 4.2, 5.01]
+WEIGHT_LABELS = ['Light', 'Medium Light', 'Medium', 'Medium Heavy', 'Heavy']
+# Playing time in minutes
+TIME_BINS = [0, 30, 60, 120, 240, float('inf')]
+TIME_LABELS = ['Under 30 min', '30-60 min', '60-120 min', '2-4 hours', 'Over 4 hours']
+# plays_<n> is 1 when n players is within the player count of a game, the last one is n or more
+PLAYER_COUNTS = [1, 2, 3, 4, 5, 6]
+
+FLAT_TYPES = {
+    'id': Integer(), 'game_rank': Integer(), 'name': String(255), 'year_published': Integer(),
+    'min_players': Integer(), 'max_players': Integer(), 'age': Integer(), 'playing_time': Integer(),
+    'average_weight': Float(), 'average': Float(), 'bayes_average': Float(), 'users_rated': Integer(),
+    'weight_bucket': String(16), 'time_bucket': String(16), 'sub_domain': String(255),
+    'thumbnail': String(255), 'image': String(255), 'mechanics': Text(), 'categories': Text(), 'publishers': Text(),
+    **{f"plays_{count}": Integer() for count in PLAYER_COUNTS},
+}
+FLAT_INDEXES = [
+    ('id',), ('game_rank',), ('year_published', 'game_rank'), ('weight_bucket', 'game_rank'), ('time_bucket', 'game_rank'),
+    ('min_players', 'max_players'), *[(f"plays_{count}", 'game_rank') for count in PLAYER_COUNTS],
+]
+
+RANKING_COLUMNS = ['position', 'id', 'game_rank', 'name', 'year_published', 'min_players', 'max_players',
+                   'average_weight', 'bayes_average', 'thumbnail']
+
+
+def bucket_columns(games):
+    # weight_bucket, time_bucket and plays_<n> of every game, from average_weight, playing_time and the player counts.
+    # The similar games use the same buckets, so a game's neighbours are grouped like the dashboard filters
+    columns = pd.DataFrame(index=games.index)
+    # The API reports 0 when nobody voted on the weight or there is no playing time, those games get no bucket
+    weight = games['average_weight'].where(games['average_weight'] > 0)
+    playing_time = games['playing_time'].where(games['playing_time'] > 0)
+    columns['weight_bucket'] = pd.cut(weight, WEIGHT_BINS, labels=WEIGHT_LABELS, right=False).astype(object)
+    columns['time_bucket'] = pd.cut(playing_time, TIME_BINS, labels=TIME_LABELS, right=False).astype(object)
+    for count in PLAYER_COUNTS:
+        fits = games['max_players'] >= count
+        if count < PLAYER_COUNTS[-1]:
+            fits &= games['min_players'] <= count
+        columns[f"plays_{count}"] = fits.astype(int)
+    return columns
+
+
+def read_flat_games(connection):
+    games = pd.read_sql(text("""
+        SELECT board_game.id, game_rank.game_rank, board_game.name, board_game.year_published,
+            board_game.min_players, board_game.max_players, board_game.age, board_game.playing_time,
+            board_game.average_weight, board_game.average, board_game.bayes_average, board_game.users_rated,
+            board_game.sub_domain, board_game.thumbnail, board_game.image
+        FROM board_game
+        INNER JOIN game_rank
+        ON board_game.id = game_rank.board_game_id
+        ORDER BY game_rank.game_rank
+    """), connection)
+
+    games = pd.concat([games, bucket_columns(games)], axis=1)
+
+    names = {}
+    for table, junction_table, column, list_column in LISTS:
+        names[table] = pd.read_sql(text(f"""
+            SELECT {junction_table}.board_game_id AS id, {table}.name
+            FROM {junction_table}
+            INNER JOIN {table}
+            ON {table}.id = {junction_table}.{column}
+        """), connection)
+        lists = names[table].sort_values('name').groupby('id')['name'].agg(', '.join)
+        games[list_column] = games['id'].map(lists)
+
+    return games, names
+
+
+def top_games(games, names, group, top_n):
+    # The top_n best ranked games of every mechanic or category, numbered from 1
+    ranked = names.rename(columns={'name': group}).merge(games[RANKING_COLUMNS[1:]], on='id')
+    ranked = ranked.sort_values([group, 'game_rank']).groupby(group).head(top_n)
+    ranked.insert(1, 'position', ranked.groupby(group).cumcount() + 1)
+    return ranked[[group, *RANKING_COLUMNS]]
+
+
+def replace_table(engine, table, df, dtypes, indexes):
+    # Load the rows into a staging table and swap it in, so the dashboard never sees a half built table
+    mysql = engine.dialect.name == 'mysql'
+    with engine.begin() as connect:
+        connect.execute(text(f"DROP TABLE IF EXISTS {table}_new"))
+        df.to_sql(f"{table}_new", connect, index=False, dtype=dtypes, chunksize=10000)
+        if mysql:
+            for columns in indexes:
+                connect.execute(text(f"CREATE INDEX {table}_{'_'.join(columns)} ON {table}_new ({', '.join(columns)})"))
+
+    if mysql:
+        # RENAME TABLE swaps both tables in one step
+        with engine.begin() as connect:
+            connect.execute(text(f"CREATE TABLE IF NOT EXISTS {table} LIKE {table}_new"))
+            connect.execute(text(f"RENAME TABLE {table} TO {table}_old, {table}_new TO {table}"))
+            connect.execute(text(f"DROP TABLE {table}_old"))
+    else:
+        # Index names are global in SQLite, so the indexes are created once the old table and its indexes are gone.
+        # pysqlite only opens a transaction by itself before INSERT, UPDATE and DELETE, without the BEGIN every
+        # statement of the swap would be committed on its own and the table could go missing
+        with engine.begin() as connect:
+            connect.exec_driver_sql("BEGIN")
+            connect.execute(text(f"DROP TABLE IF EXISTS {table}"))
+            connect.execute(text(f"ALTER TABLE {table}_new RENAME TO {table}"))
+            for columns in indexes:
+                connect.execute(text(f"CREATE INDEX {table}_{'_'.join(columns)} ON {table} ({', '.join(columns)})"))
+
+
+def write_extract(df, directory, name):
+    # Parquet when pyarrow is installed, CSV otherwise. Written next to the final file and renamed,
+    # so an extract refresh never reads a partial file
+    extension = 'parquet' if importlib.util.find_spec('pyarrow') else 'csv'
+    path = os.path.join(directory, f"{name}.{extension}")
+    if extension == 'parquet':
+        df.to_parquet(f"{path}.tmp", index=False)
+    else:
+        df.to_csv(f"{path}.tmp", index=False)
+    os.replace(f"{path}.tmp", path)
+    return path
+
+
+def build_exports(engine, directory=None, top_n=100):
+    # Rebuild board_game_flat and the top games tables, and write them as files to directory when it is set.
+    # Returns the number of rows of every export
+    with engine.connect() as connection:
+        games, names = read_flat_games(connection)
+
+    exports = {'board_game_flat': games}
+    replace_table(engine, 'board_game_flat', games, FLAT_TYPES, FLAT_INDEXES)
+
+    for table, export, group in RANKINGS:
+        ranked = top_games(games, names[table], group, top_n)
+        dtypes = {column: FLAT_TYPES[column] for column in RANKING_COLUMNS if column in FLAT_TYPES}
+        dtypes.update({group: String(255), 'position': Integer()})
+        replace_table(engine, export, ranked, dtypes, [(group, 'position')])
+        exports[export] = ranked
+
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        for export, df in exports.items():
+            write_extract(df, directory, export)
+
+    return {export: len(df) for export, df in exports.items()}
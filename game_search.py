@@ -0,0 +1,257 @@
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import sqlalchemy
+from sqlalchemy.sql import text
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+from time import perf_counter
+
+# In-memory search over the ingested catalog: filter games by mechanic, category, publisher and honor, and by
+# player count, playing time, weight and year, and get the best ranked matches back in milliseconds.
+# Serve it to the front end with
+#   python game_search.py --port 8080
+#   curl 'http://localhost:8080/search?mechanic=Deck,+Bag,+and+Pool+Building&players=2&weight=2..3&limit=20'
+
+# Facet name in queries: (lookup table, junction table, junction column)
+FACETS = {
+    'mechanic': ('mechanics', 'board_game_has_mechanics', 'mechanic_id'),
+    'category': ('categories', 'board_game_has_categories', 'category_id'),
+    'publisher': ('publishers', 'board_game_has_publishers', 'publisher_id'),
+    'honor': ('honors', 'board_game_has_honors', 'honor_id'),
+}
+
+# Range filter name in queries: board_game column
+RANGES = {
+    'min_players': 'min_players',
+    'max_players': 'max_players',
+    'time': 'playing_time',
+    'weight': 'average_weight',
+    'year': 'year_published',
+}
+
+RESULT_COLUMNS = ['id', 'game_rank', 'name', 'year_published', 'min_players', 'max_players', 'playing_time',
+                  'average_weight', 'bayes_average', 'thumbnail']
+
+
+class Facet:
+    # Inverted index of one facet. The games of every value are a sorted array of rank positions, all stored
+    # back to back in positions, with offsets marking where each value starts (like a CSR matrix).
+    # codes holds the value of every entry of positions, which makes counting values one bincount
+    def __init__(self, names, positions, codes):
+        order = np.lexsort((positions, codes))
+        self.names = names
+        self.codes = {name: code for code, name in enumerate(names)}
+        self.positions = positions[order]
+        self.value_codes = codes[order]
+        self.offsets = np.searchsorted(self.value_codes, np.arange(len(names) + 1))
+
+    def games(self, name):
+        code = self.codes.get(name)
+        if code is None:
+            return self.positions[:0]
+        return self.positions[self.offsets[code]:self.offsets[code + 1]]
+
+    def counts(self, mask, limit):
+        # How many of the games in mask have each value, the limit most common values first
+        counts = np.bincount(self.value_codes[mask[self.positions]], minlength=len(self.names))
+        top = np.argsort(-counts, kind='stable')[:limit]
+        return {self.names[code]: int(counts[code]) for code in top if counts[code]}
+
+
+class RangeIndex:
+    # Rank positions sorted by value, a range of values is then a slice found with two binary searches.
+    # Games without a value are left out
+    def __init__(self, values):
+        values = values.astype('float64')
+        known = np.flatnonzero(~np.isnan(values))
+        order = known[np.argsort(values[known], kind='stable')]
+        self.values = values[order]
+        self.positions = order
+
+    def games(self, low=None, high=None):
+        start = 0 if low is None else np.searchsorted(self.values, low, side='left')
+        end = len(self.values) if high is None else np.searchsorted(self.values, high, side='right')
+        return self.positions[start:end]
+
+
+def known_values(games, name):
+    # The values of a range filter with the ones BGG has no value for as NaN. BGG stores those as 0, and
+    # years before 1 AD are negative, so only year 0 is unknown while no game has 0 players, minutes or weight
+    values = games[RANGES[name]]
+    known = values != 0 if name == 'year' else values > 0
+    return values.where(known).to_numpy()
+
+
+class GameIndex:
+    # Games are kept in rank order, so a game's position in every array is its rank order and the first
+    # matches of a filter are already the top ranked ones
+    def __init__(self, games, links):
+        self.size = len(games)
+        self.columns = {column: games[column].to_numpy() for column in RESULT_COLUMNS}
+        self.ranges = {name: RangeIndex(known_values(games, name)) for name in RANGES}
+
+        position_of = pd.Series(np.arange(self.size, dtype='int32'), index=games['id'].to_numpy())
+        self.facets = {}
+        for facet, rows in links.items():
+            rows = rows[rows['id'].isin(position_of.index)]
+            codes, names = pd.factorize(rows['name'], sort=True)
+            positions = position_of.loc[rows['id']].to_numpy()
+            self.facets[facet] = Facet(list(names), positions, codes.astype('int32'))
+
+    @classmethod
+    def from_database(cls, engine):
+        with engine.connect() as connection:
+            games = pd.read_sql(text(f"""
+                SELECT {', '.join('board_game.' + column for column in RESULT_COLUMNS if column != 'game_rank')},
+                    game_rank.game_rank
+                FROM board_game
+                INNER JOIN game_rank
+                ON board_game.id = game_rank.board_game_id
+                ORDER BY game_rank.game_rank
+            """), connection)
+
+            links = {}
+            for facet, (table, junction_table, column) in FACETS.items():
+                links[facet] = pd.read_sql(text(f"""
+                    SELECT DISTINCT {junction_table}.board_game_id AS id, {table}.name
+                    FROM {junction_table}
+                    INNER JOIN {table}
+                    ON {table}.id = {junction_table}.{column}
+                """), connection)
+
+        return cls(games, links)
+
+    def search(self, facets=None, ranges=None, players=None, limit=20, offset=0, facet_counts=10):
+        # facets maps a facet to the values a game must all have, e.g. {'mechanic': ['Hand Management']}.
+        # ranges maps a range filter to (low, high), either end can be None. players keeps the games that
+        # can be played by that many players. Returns the matches from offset on in rank order, how many games
+        # matched, and the most common values of every facet among the matches
+        mask = np.ones(self.size, dtype=bool)
+        for facet, names in (facets or {}).items():
+            for name in names:
+                mask &= self.select(self.facets[facet].games(name))
+        for name, (low, high) in (ranges or {}).items():
+            mask &= self.select(self.ranges[name].games(low, high))
+        if players is not None:
+            mask &= self.select(self.ranges['min_players'].games(None, players))
+            mask &= self.select(self.ranges['max_players'].games(players, None))
+
+        matches = np.flatnonzero(mask)
+        page = matches[offset:offset + limit]
+        return {
+            'total': len(matches),
+            'games': [
+                {column: to_json(values[position]) for column, values in self.columns.items()}
+                for position in page
+            ],
+            'facets': {facet: index.counts(mask, facet_counts) for facet, index in self.facets.items()} if facet_counts else {},
+        }
+
+    def select(self, positions):
+        selected = np.zeros(self.size, dtype=bool)
+        selected[positions] = True
+        return selected
+
+
+def to_json(value):
+    # NumPy scalars and NaN are not JSON
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+def parse_range(text):
+    # "2..3", "2015.." or "..60", a single value like "4" matches only that value.
+    # Not a "-", BGG has plenty of games published in negative years, e.g. year=-3000..-1000
+    if '..' not in text:
+        return float(text), float(text)
+    low, _, high = text.partition('..')
+    return (float(low) if low else None, float(high) if high else None)
+
+
+def parse_query(query):
+    # Turn the query string of /search into keyword arguments for GameIndex.search.
+    # Facet values can be repeated, e.g. ?mechanic=Dice+Rolling&mechanic=Set+Collection
+    params = parse_qs(query)
+    parsed = {
+        'facets': {facet: params[facet] for facet in FACETS if facet in params},
+        'ranges': {name: parse_range(params[name][0]) for name in RANGES if name in params},
+        'players': int(params['players'][0]) if 'players' in params else None,
+        'limit': min(int(params.get('limit', ['20'])[0]), 500),
+        'offset': int(params.get('offset', ['0'])[0]),
+        'facet_counts': int(params.get('facet_counts', ['10'])[0]),
+    }
+    # A negative limit or offset would slice from the end of the matches
+    for name in ['limit', 'offset', 'facet_counts']:
+        if parsed[name] < 0:
+            raise ValueError(f"{name} can not be negative")
+    return parsed
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/search':
+            return self.send_json(404, {'error': 'not found'})
+        try:
+            query = parse_query(url.query)
+        except ValueError as e:
+            return self.send_json(400, {'error': str(e)})
+
+        started = perf_counter()
+        result = self.server.index.search(**query)
+        result['took_ms'] = round((perf_counter() - started) * 1000, 3)
+        self.send_json(200, result)
+
+    def send_json(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        # The front end is served from another origin
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(index, host='127.0.0.1', port=8080):
+    server = ThreadingHTTPServer((host, port), SearchHandler)
+    server.daemon_threads = True
+    server.index = index
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a faceted search over the board game database")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+
+    # The same settings as pipe_in_data.py
+    load_dotenv()
+    user = os.getenv("USER")
+    password = os.getenv("PASSWORD")
+    database = os.getenv("DATABASE")
+    server = os.getenv("SERVER")
+    engine = sqlalchemy.create_engine(os.getenv("DATABASE_URL") or f'mysql+pymysql://{user}:{password}@{server}/{database}')
+
+    started = perf_counter()
+    index = GameIndex.from_database(engine)
+    engine.dispose()
+    print(f"Indexed {index.size} games in {perf_counter() - started:.1f}s")
+
+    print(f"Serving on http://{args.host}:{args.port}/search")
+    serve(index, args.host, args.port).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+import hashlib
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+from sqlalchemy.sql import text, bindparam
+from dashboard_exports import PLAYER_COUNTS, bucket_columns
+
+# "Games like this one": every game is a sparse vector of its mechanics, categories, weight, playing time and
+# player counts, and board_game_similar holds the top_k games with the highest cosine similarity to it.
+# A vector only depends on the game's own data, so after the first run only the games whose features changed,
+# and the games that had one of those among their neighbours, are computed again
+
+# How much each group of features counts. Within a group every feature of a game weighs the same
+FEATURE_WEIGHTS = {
+    'mechanic': 1.0,
+    'category': 0.8,
+    'weight': 0.5,
+    'time': 0.3,
+    'players': 0.4,
+}
+
+# (lookup table, junction table, junction column, feature group)
+LINKS = [
+    ('mechanics', 'board_game_has_mechanics', 'mechanic_id', 'mechanic'),
+    ('categories', 'board_game_has_categories', 'category_id', 'category'),
+]
+
+# Above this share of changed games it is quicker to compute everything again
+FULL_REBUILD_SHARE = 0.25
+# Scores are computed for about this many pairs of games at a time, 2 ** 24 float32 scores are 64 MB
+BLOCK_SCORES = 2 ** 24
+
+
+def create_tables(connection):
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS board_game_similar (
+            board_game_id INT,
+            position INT,
+            similar_id INT,
+            score FLOAT,
+            PRIMARY KEY (board_game_id, position)
+        )
+    """))
+    # The features every game had when its neighbours were last computed
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS board_game_similar_features (
+            id INT PRIMARY KEY,
+            feature_hash CHAR(16)
+        )
+    """))
+
+
+def read_features(connection):
+    # Returns the game ids in order and a (position, feature group, feature name) row for every feature.
+    # Games are ordered by id rather than rank, so how ties are broken does not move with the ranks
+    games = pd.read_sql(text("""
+        SELECT id, min_players, max_players, playing_time, average_weight
+        FROM board_game
+        ORDER BY id
+    """), connection)
+    position_of = pd.Series(np.arange(len(games)), index=games['id'].to_numpy())
+
+    features = []
+    for table, junction_table, column, group in LINKS:
+        rows = pd.read_sql(text(f"""
+            SELECT DISTINCT {junction_table}.board_game_id AS id, {table}.name
+            FROM {junction_table}
+            INNER JOIN {table}
+            ON {table}.id = {junction_table}.{column}
+        """), connection)
+        rows = rows[rows['id'].isin(position_of.index)]
+        features.append(pd.DataFrame({'position': position_of.loc[rows['id']].to_numpy(), 'group': group, 'name': rows['name'].to_numpy()}))
+
+    # The buckets and player counts of the dashboard
+    buckets = bucket_columns(games)
+    for group, column in [('weight', 'weight_bucket'), ('time', 'time_bucket')]:
+        known = buckets[column].notna().to_numpy()
+        features.append(pd.DataFrame({'position': np.flatnonzero(known), 'group': group, 'name': buckets[column][known].to_numpy()}))
+
+    for count in PLAYER_COUNTS:
+        fits = buckets[f"plays_{count}"].to_numpy(dtype=bool)
+        features.append(pd.DataFrame({'position': np.flatnonzero(fits), 'group': 'players', 'name': str(count)}))
+
+    return games['id'].to_numpy(), pd.concat(features, ignore_index=True)
+
+
+def feature_matrix(size, features):
+    # Rows are games and columns features. Each group gets its weight spread over the features the game has
+    # in it, then every row is scaled to length 1 so a dot product is the cosine similarity
+    labels = features['group'] + ':' + features['name']
+    columns, _ = pd.factorize(labels)
+    group_sizes = features.groupby(['position', 'group'])['name'].transform('size').to_numpy()
+    values = features['group'].map(FEATURE_WEIGHTS).to_numpy() / np.sqrt(group_sizes)
+
+    matrix = sparse.csr_matrix((values.astype('float32'), (features['position'].to_numpy(), columns)), shape=(size, columns.max() + 1 if len(columns) else 1))
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.csr_matrix(sparse.diags(1 / norms).astype('float32') @ matrix)
+
+
+def feature_hashes(size, features):
+    # A fingerprint of the features of every game, independent of the order they were read in
+    labels = (features['group'] + ':' + features['name']).to_numpy()
+    order = np.lexsort((labels, features['position'].to_numpy()))
+    joined = pd.Series(labels[order]).groupby(features['position'].to_numpy()[order]).agg('|'.join)
+    joined = joined.reindex(range(size), fill_value='')
+    return [hashlib.blake2b(key.encode(), digest_size=8).hexdigest() for key in joined]
+
+
+def top_similar(scores, exclude, top_k):
+    # The top_k columns of every row of scores as (column, score in millionths) pairs, best first.
+    # Scores are compared at 6 decimals and of equal scores the lower column, the lower id, wins,
+    # so every choice between equal scores comes out the same in every run
+    rows_count, size = scores.shape
+    top_k = min(top_k, size - 1)
+    if top_k <= 0:
+        return [[] for _ in range(rows_count)]
+
+    scores[np.arange(rows_count), exclude] = -np.inf
+    # The top_k-th best score among every 16th game is at most the top_k-th best score among all games, and
+    # only games within rounding distance of that can make it in. Partitioning the sample is 16 times cheaper.
+    # A game with nothing in common, a score that rounds to 0, is never a neighbour, so a row with few games
+    # that share anything with it does not take every game as a candidate
+    sample = scores[:, ::16] if size // 16 > top_k else scores
+    kth = np.partition(sample, sample.shape[1] - top_k, axis=1)[:, sample.shape[1] - top_k]
+    threshold = np.maximum(kth - 1e-6, 5e-7)
+    # flatnonzero of the flat mask is much quicker than nonzero of the 2D one
+    rows, columns = np.divmod(np.flatnonzero((scores >= threshold[:, None]).ravel()), size)
+    millionths = np.rint(scores[rows, columns] * 1e6).astype(np.int64)
+
+    order = np.lexsort((columns, -millionths, rows))
+    rows, columns, millionths = rows[order], columns[order], millionths[order]
+    within_row = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    keep = (within_row < top_k) & (millionths > 0)
+    rows, columns, millionths = rows[keep], columns[keep], millionths[keep]
+
+    neighbours = [[] for _ in range(rows_count)]
+    for row, column, score in zip(rows.tolist(), columns.tolist(), millionths.tolist()):
+        neighbours[row].append((column, score))
+    return neighbours
+
+
+def compute_rows(matrix, positions, top_k, block_size):
+    # Neighbours of the games at positions against every game, block_size rows at a time so memory stays at
+    # block_size x games scores however big the catalog gets. The sparse rows times the dense matrix add up
+    # every score in the same order however the blocks fall, merge_changed relies on that.
+    # Games without features have no neighbours and are no one's neighbour, so they are left out of the scores
+    active = np.flatnonzero(np.diff(matrix.indptr))
+    dense = matrix[active].T.toarray()
+    neighbours = {position: [] for position in positions.tolist()}
+    positions = positions[np.isin(positions, active)]
+    for start in range(0, len(positions), block_size):
+        block = positions[start:start + block_size]
+        rows = top_similar(matrix[block] @ dense, np.searchsorted(active, block), top_k)
+        for position, row in zip(block.tolist(), rows):
+            neighbours[position] = [(int(active[column]), score) for column, score in row]
+    return neighbours
+
+
+def merge_changed(matrix, positions, changed, stored, top_k, block_size):
+    # Games whose features and neighbours did not change can only gain a changed game as a neighbour,
+    # so they are only compared to the changed games and the result merged with what is stored.
+    # Games without features are left out on both sides, like in compute_rows
+    featured = np.diff(matrix.indptr) > 0
+    positions, changed = positions[featured[positions]], changed[featured[changed]]
+    neighbours = {}
+    changed_dense = matrix[changed].T.toarray()
+    for start in range(0, len(positions), block_size):
+        block = positions[start:start + block_size].tolist()
+        millionths = np.rint((matrix[block] @ changed_dense) * 1e6).astype(np.int64)
+        # Only a changed game that scores at least as high as the weakest stored neighbour can get into a full list,
+        # and any game with a score above 0 into a shorter one
+        weakest = np.array([stored[position][-1][1] if len(stored[position]) >= top_k else 1 for position in block])
+        rows, columns = np.nonzero(millionths >= weakest[:, None])
+
+        candidates = {}
+        for row, column in zip(rows.tolist(), columns.tolist()):
+            candidates.setdefault(block[row], []).append((int(changed[column]), int(millionths[row, column])))
+        for position, new in candidates.items():
+            best = sorted(stored[position] + new, key=lambda candidate: (-candidate[1], candidate[0]))[:top_k]
+            if best != stored[position]:
+                neighbours[position] = best
+    return neighbours
+
+
+def delete_ids(connection, table, column, ids):
+    delete_query = text(f"DELETE FROM {table} WHERE {column} IN :ids").bindparams(bindparam("ids", expanding=True))
+    for start in range(0, len(ids), 1000):
+        connection.execute(delete_query, {"ids": ids[start:start + 1000]})
+
+
+def build_similar(engine, top_k=10):
+    # Bring board_game_similar up to date and return how many games got new neighbours
+    with engine.begin() as connection:
+        create_tables(connection)
+        ids, features = read_features(connection)
+        stored_hashes = dict(connection.execute(text("SELECT id, feature_hash FROM board_game_similar_features")).fetchall())
+        stored_rows = connection.execute(text("SELECT board_game_id, similar_id, score FROM board_game_similar ORDER BY board_game_id, position")).fetchall()
+
+    size = len(ids)
+    if size == 0:
+        return 0
+    matrix = feature_matrix(size, features)
+    block_size = min(max(BLOCK_SCORES // size, 64), 1024)
+    hashes = feature_hashes(size, features)
+    position_of = {game_id: position for position, game_id in enumerate(ids.tolist())}
+
+    changed = np.array([position for position, game_id in enumerate(ids.tolist()) if stored_hashes.get(game_id) != hashes[position]], dtype=int)
+    gone_ids = set(stored_hashes) - set(position_of)
+
+    # Neighbours as (position, score in millionths), for every game whose stored list only holds games that are still
+    # there and no score of 0, which earlier versions stored. A game that shares no feature with any other has an empty list
+    stored = {position_of[game_id]: [] for game_id in stored_hashes if game_id in position_of}
+    stale = set()
+    for game_id, similar_id, score in stored_rows:
+        if game_id not in position_of:
+            continue
+        if similar_id in position_of and score > 0:
+            stored.setdefault(position_of[game_id], []).append((position_of[similar_id], round(score * 1e6)))
+        else:
+            stale.add(position_of[game_id])
+
+    if len(changed) > size * FULL_REBUILD_SHARE or not stored:
+        dirty = np.arange(size)
+        neighbours = compute_rows(matrix, dirty, top_k, block_size)
+    else:
+        # A game has to be computed again when it changed, when a changed game was one of its neighbours,
+        # or when its list was cut short by games that are gone. A list that is short because few games share
+        # anything with it only grows with changed games, which merge_changed takes care of
+        changed_set = set(changed.tolist())
+        dirty = set(changed_set) | stale
+        for position, row in stored.items():
+            if any(other in changed_set for other, _ in row):
+                dirty.add(position)
+        dirty.update(position for position in range(size) if position not in stored)
+        dirty = np.array(sorted(dirty), dtype=int)
+
+        neighbours = compute_rows(matrix, dirty, top_k, block_size)
+        if len(changed):
+            others = np.setdiff1d(np.arange(size), dirty)
+            neighbours.update(merge_changed(matrix, others, changed, stored, top_k, block_size))
+
+    with engine.begin() as connection:
+        if len(dirty) == size:
+            connection.execute(text("DELETE FROM board_game_similar"))
+            connection.execute(text("DELETE FROM board_game_similar_features"))
+        else:
+            updated_ids = [int(ids[position]) for position in neighbours] + sorted(gone_ids)
+            delete_ids(connection, 'board_game_similar', 'board_game_id', updated_ids)
+            delete_ids(connection, 'board_game_similar_features', 'id', updated_ids)
+
+        rows = [
+            {"board_game_id": int(ids[position]), "position": rank, "similar_id": int(ids[other]), "score": score / 1e6}
+            for position, row in neighbours.items()
+            for rank, (other, score) in enumerate(row, start=1)
+        ]
+        insert_query = text("INSERT INTO board_game_similar (board_game_id, position, similar_id, score) VALUES (:board_game_id, :position, :similar_id, :score)")
+        for start in range(0, len(rows), 10000):
+            connection.execute(insert_query, rows[start:start + 10000])
+
+        # Every changed game is among the games that were computed, so their features are recorded here too
+        feature_rows = [{"id": int(ids[position]), "feature_hash": hashes[position]} for position in neighbours]
+        insert_query = text("INSERT INTO board_game_similar_features (id, feature_hash) VALUES (:id, :feature_hash)")
+        for start in range(0, len(feature_rows), 10000):
+            connection.execute(insert_query, feature_rows[start:start + 10000])
+
+    return len(neighbours)
@@ -1,457 +1,887 @@
 import traceback
-import requests
-import pandas as pd
+import sqlite3
+import signal
+import threading
+import queue
+import multiprocessing
+import random
+import hashlib
+import re
+import unicodedata
+import argparse
+import importlib.util
 import sqlalchemy
-import xml.etree.ElementTree as ET
-from sqlalchemy.sql import text
-from time import sleep
+from sqlalchemy.sql import text, bindparam
+from time import sleep, monotonic
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from email.utils import parsedate_to_datetime
 import os
-
-# Load environment variables from .env file
+from response_cache import ResponseCache
+from bgg_parser import parse_games, ParseError
+from pipeline_metrics import Metrics, Progress
+# pandas, numpy, requests and the export modules are imported by the phases that use them,
+# so a targeted refresh of a few games starts without paying for them
+
+COMMANDS = '''commands:
+  all             every phase below in order, resuming from the last checkpoint (the default)
+  ingest-new      fetch the games that are not in the database yet
+  rank            rebuild game_rank from boardgames_ranks.csv for the games in the database
+  refresh-movers  fetch the games whose stats changed since they were last written
+  prune           delete the games that are not in game_rank, run rank first
+  export          rebuild the dashboard tables, the extract files and the similar games
+
+ingest-new and refresh-movers with --ids only fetch those games and do not read boardgames_ranks.csv, e.g.
+  python pipe_in_data.py refresh-movers --ids 174430,224517'''
+
+def id_list(value):
+    return [int(game_id) for game_id in value.split(',') if game_id.strip()]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Update the board game database from the BoardGameGeek API",
+                                     epilog=COMMANDS, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', nargs='?', default='all', choices=['all', 'ingest-new', 'rank', 'refresh-movers', 'prune', 'export'])
+    parser.add_argument('--offline', action='store_true', help="only use API responses that are already in the response cache")
+    parser.add_argument('--shards', type=int, default=1, help="fetch and parse in this many processes, each with its own fetch workers")
+    parser.add_argument('--limit', type=int, help="only fetch the first LIMIT games of a phase, in rank order. The next run goes on from there")
+    parser.add_argument('--ids', type=id_list, help="comma separated game ids to fetch instead of working through the csv file")
+    args = parser.parse_args()
+    if args.ids is not None and args.command not in ('ingest-new', 'refresh-movers'):
+        parser.error("--ids only applies to ingest-new and refresh-movers")
+    if args.limit is not None and args.command not in ('all', 'ingest-new', 'refresh-movers'):
+        parser.error("--limit only applies to all, ingest-new and refresh-movers")
+    return args
+
+# Load environment variables from .env file, before the settings below are read
 load_dotenv()
 
-# Access the variables
-user = os.getenv("USER")
-password = os.getenv("PASSWORD")
-database = os.getenv("DATABASE")
-server = os.getenv("SERVER")
-
-# Connect to the database
-engine = sqlalchemy.create_engine(f'mysql+pymysql://{user}:{password}@{server}/{database}')
-
-
-# Sort the board game cvs file by rank, bayesaverage, and average and remove any rows with 0 values, then strip the list to only include the id column
-df = pd.read_csv('boardgames_ranks.csv')
-df = df.replace(0, pd.NA)
-sorted_list = df.sort_values(by=['rank', 'bayesaverage', 'average'], ascending=[True, False, False], na_position='last')
-stripped_list = sorted_list[['id']]
-new_games = 0
-errored_ids =[]
-
-stripped_list.to_csv('stripped_list.csv', index=False)
-
-def print_progress_bar(current, total, bar_length=50):
-    progress = current / total
-    block = int(bar_length * progress)
-    bar = "#" * block + "-" * (bar_length - block)
-    percentage = progress * 100
-    print(f"\r[{bar}] {percentage:.2f}%", end='', flush=True)
-
-def fetch_data(url, retries=5, delay=5):
+# The XML API accepts a comma separated list of ids, so games are requested in batches
+API_URL = os.getenv("BGG_API_URL", "https://api.geekdo.com/xmlapi")
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", 20))
+
+# Fetch workers share one rate limit, and at most QUEUE_SIZE batches wait for the database writer
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", 4))
+REQUESTS_PER_SECOND = float(os.getenv("REQUESTS_PER_SECOND", 2))
+QUEUE_SIZE = int(os.getenv("QUEUE_SIZE", 16))
+
+# API responses are cached on disk per game, set RESPONSE_CACHE to an empty string to turn the cache off
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "bgg_cache.sqlite")
+CACHE_TTL = float(os.getenv("CACHE_TTL", 12 * 60 * 60))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", 1024 ** 3))
+
+# Parsed games are written to the database WRITE_BATCH_SIZE games at a time, and every write is committed with a checkpoint
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", 500))
+# How many more times games that could not be fetched are tried again at the end of a phase
+RETRY_ROUNDS = int(os.getenv("RETRY_ROUNDS", 2))
+
+# Timings and counters of the run are written to METRICS_FILE as JSON when it ends, and in the Prometheus
+# text format to PROMETHEUS_FILE when that is set. Either one can be turned off with an empty string
+METRICS_FILE = os.getenv("METRICS_FILE", "pipeline_metrics.json")
+PROMETHEUS_FILE = os.getenv("PROMETHEUS_FILE", "")
+
+# Once the tables are up to date the flat tables for the dashboard are rebuilt, and written as extract files
+# to EXPORT_DIR. EXPORT_TOP_N is how many games the per mechanic and per category rankings hold
+EXPORT_DIR = os.getenv("EXPORT_DIR", "exports")
+EXPORT_TOP_N = int(os.getenv("EXPORT_TOP_N", 100))
+# How many similar games board_game_similar keeps per game, 0 skips the similarity stage
+SIMILAR_TOP_K = int(os.getenv("SIMILAR_TOP_K", 10))
+
+metrics = Metrics()
+
+# Set up by main(), or by run_shard in a shard process, so importing this file does not parse the command line,
+# connect to the database or open the response cache
+args = None
+engine = None
+rate_limiter = None
+response_cache = None
+# Only use responses that are already in the response cache
+offline = False
+
+def create_engine():
+    # DATABASE_URL replaces the MySQL settings, e.g. sqlite:///vault.db for a local stand-in
+    user = os.getenv("USER")
+    password = os.getenv("PASSWORD")
+    database = os.getenv("DATABASE")
+    server = os.getenv("SERVER")
+    engine = sqlalchemy.create_engine(os.getenv("DATABASE_URL") or f'mysql+pymysql://{user}:{password}@{server}/{database}')
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    sqlalchemy.event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+    return engine
+
+# Count and time every statement sent to the database
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['statement_started'] = monotonic()
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    metrics.add_time('db_execute', monotonic() - conn.info.pop('statement_started'))
+    metrics.count('db_statements')
+
+
+# Columns of boardgames_ranks.csv that the ranking needs, and the smallest types that hold them
+RANK_COLUMNS = {'id': 'int32', 'rank': 'int32', 'bayesaverage': 'float64', 'average': 'float64', 'usersrated': 'int32'}
+
+def sort_key(values, descending=False):
+    import numpy as np
+    # Zeros and blanks count as missing and sort last either way
+    values = values.to_numpy(dtype='float64')
+    key = -values if descending else values.copy()
+    key[(values == 0) | np.isnan(values)] = np.inf
+    return key
+
+def load_ranks(path):
+    # Sort the board game csv file by rank, bayesaverage, and average, and return the ids in that order together
+    # with a fingerprint of each game's stats, as NumPy arrays. pyarrow parses the file when it is installed
+    import numpy as np
+    import pandas as pd
+    engine = 'pyarrow' if importlib.util.find_spec('pyarrow') else 'c'
+    df = pd.read_csv(path, usecols=list(RANK_COLUMNS), dtype=RANK_COLUMNS, engine=engine)
+
+    # A game only needs to be fetched again once the fingerprint of its stats changes
+    stats_hashes = pd.util.hash_pandas_object(df[['bayesaverage', 'average', 'usersrated']], index=False).to_numpy()
+
+    # np.lexsort sorts by the last key first and is stable, like the sort_values call it replaces
+    order = np.lexsort((sort_key(df['average'], True), sort_key(df['bayesaverage'], True), sort_key(df['rank'])))
+    return df['id'].to_numpy()[order], stats_hashes[order]
+
+class RateLimiter:
+    # Token bucket shared by all fetch workers. A 429 from the API pauses every worker, not just the one that got it
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, monotonic() + seconds)
+            self.tokens = 0
+
+sessions = threading.local()
+
+def get_session():
+    import requests
+    # requests sessions are not thread safe, so every fetch worker keeps its own connection pool
+    if not hasattr(sessions, 'session'):
+        sessions.session = requests.Session()
+    return sessions.session
+
+def retry_after(response, default):
+    try:
+        return float(response.headers.get('Retry-After', default))
+    except ValueError:
+        return default
+
+def fetch_data(url, headers=None, retries=5, delay=5):
+    import requests
     for attempt in range(retries):
+        backoff = delay * 2 ** attempt + random.uniform(0, 1)
+        with metrics.timer('rate_limit_wait'):
+            rate_limiter.wait()
+        started = monotonic()
         try:
-            response = requests.get(url, timeout=60)
+            response = get_session().get(url, headers=headers, timeout=60)
+            metrics.observe('http_request_seconds', monotonic() - started)
+            metrics.count('http_requests', status=response.status_code)
+            metrics.count('http_bytes', len(response.content))
+            # 202 means the API queued the request and 429 means we are going too fast, either way try again later
+            if response.status_code in (202, 429):
+                wait = retry_after(response, backoff)
+                if response.status_code == 429:
+                    rate_limiter.pause(wait)
+                if attempt < retries - 1:
+                    metrics.count('http_retries', reason=response.status_code)
+                    sleep(wait)
+                    continue
+                print(f"Attempt {attempt + 1} failed: the API kept answering {response.status_code}")
+                return None
             response.raise_for_status()  # Raise an HTTPError for bad responses
-            return response.content  # or response.json(), response.text() depending on your need
+            return response  # 200, or 304 when the cached copies we asked about are still current
         except requests.RequestException as e:
+            metrics.count('http_errors', error=type(e).__name__)
             if attempt < retries - 1:
-                sleep(delay)
+                metrics.count('http_retries', reason=type(e).__name__)
+                sleep(backoff)
             else:
                 print(f"Attempt {attempt + 1} failed: {e}")
                 return None
 
-game_rank = 1  # Initialize game_rank
-
-def find_text(element, path):
-    found = element.find(path)
-    return found.text if found is not None else None
-
-
-connection = engine.connect()
-transaction = connection.begin()
-
-try:
-    print("Adjusting ranks and adding new games")
-    # Get the old ranks from the game_rank table
-    old_ranks_query = text("SELECT board_game_id, game_rank FROM game_rank")
-    old_ranks_result = connection.execute(old_ranks_query)
-    old_ranks = {row[0]: row[1] for row in old_ranks_result}  
-
-    # Delete all rows from the game_rank table
-    delete_query = text("DELETE FROM game_rank")
-    connection.execute(delete_query)
-
-    #Update the game_rank table, and add any new board games to the board_game table
-    total_items = len(stripped_list)
-    print(f"Length of list: {total_items}")
-    last_printed_progress = 0
-    
-    # Update the game_rank table, and add any new board games to the board_game table
-    for index, row in stripped_list.iterrows():
-        # Check if the board_game exists
-        select_query = text("SELECT * FROM board_game WHERE id = :val1")
-        result = connection.execute(select_query, {"val1": row['id']})
-        if result.fetchone() is not None:
-            # If the board_game exists, insert the game_rank
-            insert_query = text("INSERT INTO game_rank (board_game_id, game_rank) VALUES (:val1, :val2)")
-            connection.execute(insert_query, {"val1": row['id'], "val2": game_rank})
-
-            # If the old rank is different from the new rank, update the old_rank column in the board_game table
-            if old_ranks.get(row['id']) != game_rank:
-                update_query = text("UPDATE board_game SET old_rank = :val1 WHERE id = :val2")
-                connection.execute(update_query, {"val1": old_ranks.get(row['id']), "val2": row['id']})
-
-            print_progress_bar(game_rank, total_items)
-
-            game_rank += 1  # Increment game_rank
-    
-
+def revalidation_headers(entries):
+    # Ask the API to answer 304 Not Modified if none of these cached games changed
+    headers = {}
+    etags = {entry.etag for entry in entries}
+    if len(etags) == 1 and None not in etags:
+        headers['If-None-Match'] = etags.pop()
+    last_modified = [entry.last_modified for entry in entries]
+    if last_modified and None not in last_modified:
+        headers['If-Modified-Since'] = min(last_modified, key=parsedate_to_datetime)
+    return headers
+
+def read_games(body):
+    with metrics.timer('parse'):
+        return {game_id: game for game_id, game, _ in parse_games(body)}
+
+def fetch_games(ids, use_cache=True):
+    # Games that are in the response cache and have not expired are served from it, the rest are requested together.
+    # Without use_cache every game goes to the API, cached copies are only sent along to be revalidated
+    games = {}
+    expired = {}
+    for game_id in ids:
+        entry = response_cache.get(game_id) if response_cache else None
+        if entry is not None and (offline or (entry.fresh and use_cache)):
+            metrics.count('cache_lookups', result='hit')
+            games.update(read_games(entry.body))
+        elif entry is not None:
+            metrics.count('cache_lookups', result='expired' if not entry.fresh else 'bypassed')
+            expired[game_id] = entry
         else:
-
-            url = f"https://api.geekdo.com/xmlapi/boardgame/{row['id']}?&stats=1"
-            response = fetch_data(url)
-        
-            if response is None:
-                errored_ids.append(row['id'])
-                continue
-            
-            else:
-                # Parse the XML response with ElementTree
-                root = ET.fromstring(response)
-                boardgame = root.find('boardgame')
-
-                game_id = row['id']
-                
-                name = find_text(boardgame, 'name[@primary="true"]')
-                if name is None:
+            metrics.count('cache_lookups', result='miss')
+
+    missing = [game_id for game_id in ids if game_id not in games]
+    if not missing or offline:
+        return games
+
+    headers = revalidation_headers(list(expired.values())) if len(expired) == len(missing) else None
+
+    # Request several games at once and parse the <boardgame> elements of the response one at a time
+    url = f"{API_URL}/boardgame/{','.join(str(game_id) for game_id in missing)}?&stats=1"
+    response = fetch_data(url, headers)
+    if response is None:
+        return games
+
+    if response.status_code == 304:
+        metrics.count('cache_revalidated', len(missing))
+        response_cache.revalidated(missing)
+        for entry in expired.values():
+            games.update(read_games(entry.body))
+        return games
+
+    bodies = {}
+    try:
+        with metrics.timer('parse'):
+            for game_id, game, xml in parse_games(response.content, keep_xml=response_cache is not None):
+                games[game_id] = game
+                bodies[game_id] = xml
+    except ParseError as e:
+        metrics.count('parse_errors')
+        print(f"Error parsing XML for game IDs {missing[0]}-{missing[-1]}: {e}")
+
+    if response_cache and bodies:
+        try:
+            response_cache.put_many(bodies, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        except sqlite3.Error as e:
+            # The games were fetched all the same, they are just not cached
+            metrics.count('cache_errors', error=type(e).__name__)
+            print(f"Could not cache game IDs {missing[0]}-{missing[-1]}: {e}")
+    return games
+
+def fetch_all(ids, use_cache=True):
+    # Fetch games on a pool of worker threads while the caller writes to the database.
+    # Batches go through a bounded queue so the fetchers never get more than QUEUE_SIZE batches ahead of the writer,
+    # and results come back in the same order as ids as (game_id, GameRecord) pairs, with None for games that failed
+    batches = [ids[start:start + BATCH_SIZE] for start in range(0, len(ids), BATCH_SIZE)]
+    pending = queue.Queue(maxsize=QUEUE_SIZE)
+    stop = threading.Event()
+
+    def submit_batches(executor):
+        for batch in batches:
+            future = executor.submit(fetch_games, batch, use_cache)
+            while not stop.is_set():
+                try:
+                    pending.put((batch, future), timeout=1)
+                    break
+                except queue.Full:
                     continue
-                else:
-                    year_published = find_text(boardgame, 'yearpublished')
-                    min_players = find_text(boardgame, 'minplayers')
-                    max_players = find_text(boardgame, 'maxplayers')
-                    age = find_text(boardgame, 'age')
-                    average_weight = find_text(boardgame, 'statistics/ratings/averageweight')
-                    playing_time = find_text(boardgame, 'playingtime')
-                    min_playing_time = find_text(boardgame, 'minplaytime')
-                    max_playing_time = find_text(boardgame, 'maxplaytime')
-                    full_description = find_text(boardgame, 'description')
-                    thumbnail = find_text(boardgame, 'thumbnail')
-                    image = find_text(boardgame, 'image')
-                    subdomain = find_text(boardgame, 'boardgamesubdomain')
-                    average = find_text(boardgame, 'statistics/ratings/average')
-                    bayes_average = find_text(boardgame, 'statistics/ratings/bayesaverage')
-                    users_rated = find_text(boardgame, 'statistics/ratings/usersrated')
-                    
-                    # Insert into the board_game table (without description)
-                    insert_board_game_query = text("""
-                        INSERT INTO board_game 
-                        (id, name, year_published, min_players, max_players, age, average_weight, playing_time, min_playing_time, max_playing_time, thumbnail, image, sub_domain, average, bayes_average, users_rated, old_rank) 
-                        VALUES 
-                        (:game_id, :name, :year_published, :min_players, :max_players, :age, :average_weight, :playing_time, :min_playing_time, :max_playing_time, :thumbnail, :image, :subdomain, :average, :bayes_average, :users_rated, :old_rank)
-                    """)
-                    connection.execute(insert_board_game_query, {
-                        "game_id": row['id'],
-                        "name": name,
-                        "year_published": year_published,
-                        "min_players": min_players,
-                        "max_players": max_players,
-                        "age": age,
-                        "average_weight": average_weight,
-                        "playing_time": playing_time,
-                        "min_playing_time": min_playing_time,
-                        "max_playing_time": max_playing_time,
-                        "thumbnail": thumbnail,
-                        "image": image,
-                        "subdomain": subdomain,
-                        "average": average,
-                        "bayes_average": bayes_average,
-                        "users_rated": users_rated,
-                        "old_rank": None
-                    })
-
-                    # Insert into the board_game_description table
-                    if full_description:
-                        # Check if the description exceeds the 8000-character limit
-                        if len(full_description) > 8000:
-                            full_description = full_description[:8000]  # Truncate the description to 8000 characters
-
-                        insert_description_query = text("""
-                            INSERT INTO board_game_description 
-                            (id, full_description) 
-                            VALUES 
-                            (:game_id, :full_description)
-                        """)
-                        connection.execute(insert_description_query, {
-                            "game_id": row['id'],
-                            "full_description": full_description
-                        })
-
-
-                    insert_query = text("INSERT INTO game_rank (board_game_id, game_rank) VALUES (:val1, :val2)")
-                    connection.execute(insert_query, {"val1": row['id'], "val2": game_rank})
-
-                    # For publishers
-                    publishers = [pub.text for pub in boardgame.findall('boardgamepublisher')]
-                    for publisher in publishers:
-                        select_query = text("SELECT * FROM publishers WHERE name = :val1")
-                        result = connection.execute(select_query, {"val1": publisher})
-                        publisher_row = result.fetchone()
-                        if publisher_row is None:
-                            insert_query = text("INSERT INTO publishers (name) VALUES (:val1)")
-                            connection.execute(insert_query, {"val1": publisher})
-                            publisher_id = connection.execute(text("SELECT LAST_INSERT_ID()")).fetchone()[0]
-                        else:
-                            publisher_id = publisher_row[0]
-
-                        # Check if the record already exists in the board_game_has_publishers table
-                        select_query = text("SELECT * FROM board_game_has_publishers WHERE board_game_id = :val1 AND publisher_id = :val2")
-                        result = connection.execute(select_query, {"val1": row['id'], "val2": publisher_id})
-                        if result.rowcount == 0:
-                            insert_query = text("INSERT INTO board_game_has_publishers (board_game_id, publisher_id) VALUES (:val1, :val2)")
-                            connection.execute(insert_query, {"val1": row['id'], "val2": publisher_id})
-
-                    # For honors
-                    honors = [honor.text for honor in boardgame.findall('boardgamehonor')]
-                    for honor in honors:
-                        select_query = text("SELECT * FROM honors WHERE name = :val1")
-                        result = connection.execute(select_query, {"val1": honor})
-                        honor_row = result.fetchone()
-                        if honor_row is None:
-                            insert_query = text("INSERT INTO honors (name) VALUES (:val1)")
-                            connection.execute(insert_query, {"val1": honor})
-                            honor_id = connection.execute(text("SELECT LAST_INSERT_ID()")).fetchone()[0]
-                        else:
-                            honor_id = honor_row[0]
-
-                        # Check if the record already exists in the board_game_has_honors table
-                        select_query = text("SELECT * FROM board_game_has_honors WHERE board_game_id = :val1 AND honor_id = :val2")
-                        result = connection.execute(select_query, {"val1": row['id'], "val2": honor_id})
-                        if result.rowcount == 0:
-                            insert_query = text("INSERT INTO board_game_has_honors (board_game_id, honor_id) VALUES (:val1, :val2)")
-                            connection.execute(insert_query, {"val1": row['id'], "val2": honor_id})
-
-                    # For mechanics
-                    mechanics = [mechanic.text for mechanic in boardgame.findall('boardgamemechanic')]
-                    for mechanic in mechanics:
-                        select_query = text("SELECT * FROM mechanics WHERE name = :val1")
-                        result = connection.execute(select_query, {"val1": mechanic})
-                        mechanic_row = result.fetchone()
-                        if mechanic_row is None:
-                            insert_query = text("INSERT INTO mechanics (name) VALUES (:val1)")
-                            connection.execute(insert_query, {"val1": mechanic})
-                            mechanic_id = connection.execute(text("SELECT LAST_INSERT_ID()")).fetchone()[0]
-                        else:
-                            mechanic_id = mechanic_row[0]
-
-                        # Check if the record already exists in the board_game_has_mechanics table
-                        select_query = text("SELECT * FROM board_game_has_mechanics WHERE board_game_id = :val1 AND mechanic_id = :val2")
-                        result = connection.execute(select_query, {"val1": row['id'], "val2": mechanic_id})
-                        if result.rowcount == 0:
-                            insert_query = text("INSERT INTO board_game_has_mechanics (board_game_id, mechanic_id) VALUES (:val1, :val2)")
-                            connection.execute(insert_query, {"val1": row['id'], "val2": mechanic_id})
-
-                    # For categories
-                    categories = [category.text for category in boardgame.findall('boardgamecategory')]
-                    for category in categories:
-                        select_query = text("SELECT * FROM categories WHERE name = :val1")
-                        result = connection.execute(select_query, {"val1": category})
-                        category_row = result.fetchone()
-                        if category_row is None:
-                            insert_query = text("INSERT INTO categories (name) VALUES (:val1)")
-                            connection.execute(insert_query, {"val1": category})
-                            category_id = connection.execute(text("SELECT LAST_INSERT_ID()")).fetchone()[0]
-                        else:
-                            category_id = category_row[0]
-
-                        # Check if the record already exists in the board_game_has_categories table
-                        select_query = text("SELECT * FROM board_game_has_categories WHERE board_game_id = :val1 AND category_id = :val2")
-                        result = connection.execute(select_query, {"val1": row['id'], "val2": category_id})
-                        if result.rowcount == 0:
-                            insert_query = text("INSERT INTO board_game_has_categories (board_game_id, category_id) VALUES (:val1, :val2)")
-                            connection.execute(insert_query, {"val1": row['id'], "val2": category_id})
-
-                    
-
-                    new_games += 1
-
-                    print_progress_bar(game_rank, total_items)
-
-                    game_rank += 1  # Increment game_rank
+            if stop.is_set():
+                future.cancel()
+                return
+        pending.put(None)
+
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        producer = threading.Thread(target=submit_batches, args=(executor,), daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = pending.get()
+                if item is None:
+                    break
+                batch, future = item
+                # Time the writer spends waiting on the fetchers, if this grows the fetchers are the bottleneck
+                with metrics.timer('fetch_wait'):
+                    try:
+                        fetched = future.result() or {}
+                    except Exception as e:
+                        # Whatever went wrong with one batch, its games count as not fetched and are retried
+                        # like a failed request, instead of stopping the phase on the same batch every run
+                        metrics.count('fetch_errors', error=type(e).__name__)
+                        print(f"Error fetching game IDs {batch[0]}-{batch[-1]}: {e!r}")
+                        fetched = {}
+                for game_id in batch:
+                    yield game_id, fetched.get(game_id)
+        finally:
+            # If the writer stops early, stop queueing work and drop whatever has not started yet
+            stop.set()
+            while True:
+                try:
+                    item = pending.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    item[1].cancel()
+            producer.join()
+
+def run_shard(ids, results, rate, use_cache, offline_only, cache_path):
+    # Runs in a shard process: fetch and parse ids with the usual fetch workers and hand the GameRecords to the
+    # writer through results, one batch at a time. The metrics of the shard are sent last.
+    # Everything main() would set up is passed in, the shard does not look at the command line
+    global rate_limiter, response_cache, offline
+    rate_limiter = RateLimiter(rate, burst=FETCH_WORKERS)
+    offline = offline_only
+    # The writer's cache keeps the index and evicts, a shard only reads and adds entries
+    response_cache = ResponseCache(cache_path, CACHE_TTL, CACHE_MAX_BYTES, index=False) if cache_path else None
+    # Ctrl-C is handled by the writer, which stops the shards
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    batch = []
+    for item in fetch_all(ids, use_cache):
+        batch.append(item)
+        if len(batch) == BATCH_SIZE:
+            results.put(batch)
+            batch = []
+    if batch:
+        results.put(batch)
+
+    snapshot = metrics.snapshot()
+    # fetch_wait of the writer is its wait on the shards, a shard's own wait on its fetch workers is kept apart
+    snapshot['timers']['shard_fetch_wait'] = snapshot['timers'].pop('fetch_wait', [0.0, 0])
+    results.put(snapshot)
+    if response_cache:
+        response_cache.close()
+
+def shard_result(process, results):
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive() and results.empty():
+                raise RuntimeError(f"Shard process {process.name} exited with code {process.exitcode}")
+
+def fetch_sharded(ids, shards, use_cache=True):
+    # The same as fetch_all, but parsing is spread over several processes so it is not bound to one core.
+    # Batches are dealt out in turn, shard k gets batches k, k + shards, k + 2 * shards, ..., so the writer can
+    # take them back in rank order and checkpoints work as before. The shards split the rate limit between them
+    batches = [ids[start:start + BATCH_SIZE] for start in range(0, len(ids), BATCH_SIZE)]
+    shards = min(shards, len(batches))
+    # spawn rather than fork, the parent holds database connections and threads that must not be copied
+    context = multiprocessing.get_context('spawn')
+
+    processes = []
+    for shard in range(shards):
+        results = context.Queue(maxsize=QUEUE_SIZE)
+        shard_ids = [game_id for batch in batches[shard::shards] for game_id in batch]
+        process = context.Process(target=run_shard, args=(shard_ids, results, REQUESTS_PER_SECOND / shards, use_cache, offline, RESPONSE_CACHE), name=f"shard-{shard}", daemon=True)
+        process.start()
+        processes.append((process, results))
+
+    try:
+        for index in range(len(batches)):
+            process, results = processes[index % shards]
+            with metrics.timer('fetch_wait'):
+                fetched = shard_result(process, results)
+            if index + shards >= len(batches):
+                # That was the last batch of this shard, its metrics come next.
+                # Read them now, the caller may not ask for anything after the last game
+                metrics.merge(shard_result(process, results))
+                process.join()
+            yield from fetched
+    finally:
+        # If the writer stops early the shards are not needed anymore
+        for process, _ in processes:
+            if process.is_alive():
+                process.terminate()
+        # Take in what the shards added to the response cache, and evict if it grew too big
+        if response_cache:
+            response_cache.reload()
+
+# Lookup tables that games are linked to: (lookup table and GameRecord field, junction table, junction column)
+DIMENSIONS = [
+    ('publishers', 'board_game_has_publishers', 'publisher_id'),
+    ('honors', 'board_game_has_honors', 'honor_id'),
+    ('mechanics', 'board_game_has_mechanics', 'mechanic_id'),
+    ('categories', 'board_game_has_categories', 'category_id'),
+]
+
+def collation_key(name):
+    # The name as MySQL's default collations compare it: without case, accents or trailing spaces
+    decomposed = unicodedata.normalize('NFKD', name.casefold())
+    return ''.join(character for character in decomposed if not unicodedata.combining(character)).rstrip()
+
+class LookupTable:
+    # Cache of name -> id for one lookup table. The table is loaded once, after that only names
+    # that have never been seen are sent to the database, and they are inserted together.
+    # On MySQL names that differ only in case or accents are the same name to the database, so they are to the
+    # cache too, otherwise they would get a second row or fail on a unique index. SQLite compares names exactly
+    def __init__(self, connection, table):
+        self.connection = connection
+        self.table = table
+        self.mysql = connection.dialect.name == 'mysql'
+        self.ids = {}
+        for id, name in connection.execute(text(f"SELECT id, name FROM {table} ORDER BY id")):
+            self.ids.setdefault(self.key(name), id)
+
+    def key(self, name):
+        return collation_key(name) if self.mysql else name
+
+    def resolve(self, names):
+        # The first spelling of a name that is not in the table yet is the one that gets inserted
+        new_names = {}
+        for name in names:
+            key = self.key(name)
+            if key not in self.ids:
+                new_names.setdefault(key, name)
+        new_names = list(new_names.values())
+        if new_names:
+            insert_query = text(f"INSERT INTO {self.table} (name) VALUES (:name)")
+            self.connection.execute(insert_query, [{"name": name} for name in new_names])
+            metrics.count('db_rows', len(new_names), table=self.table)
+
+            select_query = text(f"SELECT id, name FROM {self.table} WHERE name IN :names ORDER BY id")
+            select_query = select_query.bindparams(bindparam("names", expanding=True))
+            for id, name in self.connection.execute(select_query, {"names": new_names}):
+                self.ids.setdefault(self.key(name), id)
+
+        return [self.ids[key] for key in dict.fromkeys(self.key(name) for name in names) if key in self.ids]
+
+def link_game(game):
+    for table, junction_table, column in DIMENSIONS:
+        writer.link(junction_table, column, game.id, lookups[table].resolve(getattr(game, table)))
+
+def record_hash(game):
+    # Fingerprint of everything that is written for a game, so a refreshed game that did not change is not written again
+    return hashlib.blake2b(repr(game).encode(), digest_size=8).hexdigest()
+
+def upsert_query(table, columns, key='id'):
+    # Insert rows, or update every column but the key when the row already exists
+    values = ", ".join(f":{column}" for column in columns)
+    updates = [column for column in columns if column != key]
+    if engine.dialect.name == 'mysql':
+        assignments = ", ".join(f"{column} = VALUES({column})" for column in updates)
+        conflict = f"ON DUPLICATE KEY UPDATE {assignments}"
+    else:
+        assignments = ", ".join(f"{column} = excluded.{column}" for column in updates)
+        conflict = f"ON CONFLICT ({key}) DO UPDATE SET {assignments}"
+    return text(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({values}) {conflict}")
+
+class BulkWriter:
+    # Collects the rows for board_game, board_game_description and the junction tables and writes them
+    # with one executemany per table once WRITE_BATCH_SIZE games are waiting, instead of one statement per row
+    def __init__(self, connection, batch_size=WRITE_BATCH_SIZE):
+        self.connection = connection
+        self.batch_size = batch_size
+        self.rows = {}
+        self.links = {}
+        self.game_ids = set()
+
+    def add(self, table, row):
+        self.rows.setdefault(table, []).append(row)
+
+    def link(self, junction_table, column, game_id, dimension_ids):
+        # A set, so a game that lists the same publisher twice only gets one row
+        links = self.links.setdefault((junction_table, column), set())
+        links.update((game_id, dimension_id) for dimension_id in dimension_ids)
+
+    def game_done(self, game_id):
+        # Returns True once batch_size games are waiting and it is time to flush
+        self.game_ids.add(game_id)
+        return len(self.game_ids) >= self.batch_size
+
+    def flush(self):
+        with metrics.timer('db_write'):
+            self.write()
+
+        self.rows = {}
+        self.links = {}
+        self.game_ids = set()
+
+    def write(self):
+        for table, rows in self.rows.items():
+            self.connection.execute(upsert_query(table, list(rows[0])), rows)
+            metrics.count('db_rows', len(rows), table=table)
+
+        game_ids = list(self.game_ids)
+        for (junction_table, column), links in self.links.items():
+            # Leave out the links that are already in the database
+            select_query = text(f"SELECT board_game_id, {column} FROM {junction_table} WHERE board_game_id IN :ids")
+            select_query = select_query.bindparams(bindparam("ids", expanding=True))
+            links = links - {tuple(row) for row in self.connection.execute(select_query, {"ids": game_ids})}
+            if links:
+                insert_query = text(f"INSERT INTO {junction_table} (board_game_id, {column}) VALUES (:val1, :val2)")
+                self.connection.execute(insert_query, [{"val1": game_id, "val2": dimension_id} for game_id, dimension_id in sorted(links)])
+                metrics.count('db_rows', len(links), table=junction_table)
+
+
+def create_staging_table(connect, mysql):
+    # The staging table takes the place of game_rank, so it is created with all of game_rank's columns, keys and
+    # indexes, read from the database rather than written out here. Returns the statements that recreate the indexes
+    # once the tables are swapped, which SQLite needs because index names are unique per database
+    if mysql:
+        # CREATE TABLE ... LIKE copies everything but the foreign keys, those are added back from information_schema
+        connect.execute(text("CREATE TABLE game_rank_new LIKE game_rank"))
+        select_query = text("""
+            SELECT key_usage.CONSTRAINT_NAME, key_usage.COLUMN_NAME, key_usage.REFERENCED_TABLE_NAME,
+                   key_usage.REFERENCED_COLUMN_NAME, rules.UPDATE_RULE, rules.DELETE_RULE
+            FROM information_schema.KEY_COLUMN_USAGE AS key_usage
+            INNER JOIN information_schema.REFERENTIAL_CONSTRAINTS AS rules
+            ON rules.CONSTRAINT_SCHEMA = key_usage.CONSTRAINT_SCHEMA AND rules.CONSTRAINT_NAME = key_usage.CONSTRAINT_NAME
+            WHERE key_usage.TABLE_SCHEMA = DATABASE() AND key_usage.TABLE_NAME = 'game_rank'
+            ORDER BY key_usage.CONSTRAINT_NAME, key_usage.ORDINAL_POSITION
+        """)
+        foreign_keys = {}
+        for name, column, table, referenced_column, on_update, on_delete in connect.execute(select_query):
+            key = foreign_keys.setdefault(name, {"columns": [], "table": table, "referenced": [], "rules": (on_update, on_delete)})
+            key["columns"].append(f"`{column}`")
+            key["referenced"].append(f"`{referenced_column}`")
+        # Left unnamed, MySQL names them game_rank_new_ibfk_<n> and renames them along with the table
+        for key in foreign_keys.values():
+            connect.execute(text(
+                f"ALTER TABLE game_rank_new ADD FOREIGN KEY ({', '.join(key['columns'])}) "
+                f"REFERENCES `{key['table']}` ({', '.join(key['referenced'])}) "
+                f"ON UPDATE {key['rules'][0]} ON DELETE {key['rules'][1]}"
+            ))
+        return []
+
+    # SQLite keeps the CREATE statements themselves, the primary key's index comes with the table
+    select_query = text("SELECT type, sql FROM sqlite_master WHERE tbl_name = 'game_rank' AND sql IS NOT NULL")
+    statements = connect.execute(select_query).fetchall()
+    create_table = next(sql for kind, sql in statements if kind == 'table')
+    connect.exec_driver_sql(re.sub(r'^CREATE TABLE\s+["`\[]?game_rank["`\]]?', 'CREATE TABLE game_rank_new', create_table, flags=re.IGNORECASE))
+    return [sql for kind, sql in statements if kind == 'index']
+
+def sync_ranks(ranked_ids):
+    # Rebuild game_rank in a handful of statements instead of one round trip per game: load the new ranks
+    # into a staging table, record the old rank of every game whose rank changed, then swap the tables
+    mysql = engine.dialect.name == 'mysql'
+    rows = [{"val1": game_id, "val2": rank} for rank, game_id in enumerate(ranked_ids, start=1)]
+
+    with engine.begin() as connect:
+        connect.execute(text("DROP TABLE IF EXISTS game_rank_new"))
+        create_indexes = create_staging_table(connect, mysql)
+
+        insert_query = text("INSERT INTO game_rank_new (board_game_id, game_rank) VALUES (:val1, :val2)")
+        for start in range(0, len(rows), 10000):
+            connect.execute(insert_query, rows[start:start + 10000])
+        metrics.count('db_rows', len(rows), table='game_rank')
+
+        # If the old rank is different from the new rank, update the old_rank column in the board_game table.
+        # MySQL before 8.0.21 would run the subqueries of the SQLite version once per game, so it joins the tables instead
+        if mysql:
+            update_query = text("""
+                UPDATE board_game
+                INNER JOIN game_rank_new
+                ON game_rank_new.board_game_id = board_game.id
+                LEFT JOIN game_rank
+                ON game_rank.board_game_id = board_game.id
+                SET board_game.old_rank = game_rank.game_rank
+                WHERE game_rank.game_rank IS NULL
+                OR game_rank.game_rank <> game_rank_new.game_rank
+            """)
+        else:
+            update_query = text("""
+                UPDATE board_game
+                SET old_rank = (SELECT game_rank.game_rank FROM game_rank WHERE game_rank.board_game_id = board_game.id)
+                WHERE id IN (
+                    SELECT game_rank_new.board_game_id
+                    FROM game_rank_new
+                    LEFT JOIN game_rank
+                    ON game_rank.board_game_id = game_rank_new.board_game_id
+                    WHERE game_rank.game_rank IS NULL
+                    OR game_rank.game_rank <> game_rank_new.game_rank
+                )
+            """)
+        connect.execute(update_query)
+
+        if not mysql:
+            # The old table's indexes go with it, which frees their names for the new table
+            connect.execute(text("ALTER TABLE game_rank RENAME TO game_rank_old"))
+            connect.execute(text("ALTER TABLE game_rank_new RENAME TO game_rank"))
+            connect.execute(text("DROP TABLE game_rank_old"))
+            for create_index in create_indexes:
+                connect.exec_driver_sql(create_index)
+
+    # RENAME TABLE swaps both tables in one step, so readers never see an empty or half filled game_rank
+    if mysql:
+        with engine.begin() as connect:
+            connect.execute(text("RENAME TABLE game_rank TO game_rank_old, game_rank_new TO game_rank"))
+        with engine.begin() as connect:
+            connect.execute(text("DROP TABLE game_rank_old"))
+
+
+def write_game(game):
+    # Queue the board_game row, the description and the links of a parsed game
+    writer.add('board_game', game.board_game_row())
+    if game.full_description:
+        writer.add('board_game_description', {"id": game.id, "full_description": game.full_description})
+
+    # Link the publishers, honors, mechanics and categories
+    link_game(game)
+
+def stats_hash(game_id):
+    # The fingerprint of the game's stats in the csv file. A run with --ids does not read the file, and with --offline
+    # the record may be older than the file, so then the game keeps the fingerprint it had (none for a new game)
+    # and the next run that asks the API still refreshes it
+    if game_id in stats_hashes and not offline:
+        return stats_hashes[game_id]
+    return fingerprints.get(game_id, (None, None))[0]
+
+def add_game(game_id, game):
+    # Queue everything for a game that is not in the database yet. Returns False when the API has no name for it
+    if game.name is None:
+        return False
+
+    write_game(game)
+    writer.add('board_game_fingerprint', {"id": game_id, "stats_hash": stats_hash(game_id), "record_hash": record_hash(game)})
+    return True
+
+def refresh_game(id, game):
+    # A record without a name is not a game, writing it would blank out the row that is there
+    if game.name is None:
+        return False
+
+    # Only write the game if something in its record actually changed
+    fingerprint = record_hash(game)
+    if fingerprint != fingerprints.get(id, (None, None))[1]:
+        write_game(game)
+
+    writer.add('board_game_fingerprint', {"id": id, "stats_hash": stats_hash(id), "record_hash": fingerprint})
+    return True
+
+def load_checkpoint(phase):
+    # How far an earlier run over the same list got with this phase: (last rank position, ids still to retry).
+    # A run with --ids has no list and no checkpoints
+    if list_hash is None:
+        return -1, []
+    select_query = text("SELECT position, errored_ids FROM ingest_checkpoint WHERE phase = :phase AND list_hash = :list_hash")
+    row = connection.execute(select_query, {"phase": phase, "list_hash": list_hash}).fetchone()
+    if row is None:
+        return -1, []
+    return row[0], [int(game_id) for game_id in row[1].split(',') if game_id]
+
+def save_checkpoint(phase, position, errored_ids):
+    if list_hash is None:
+        return
+    connection.execute(upsert_query('ingest_checkpoint', ['phase', 'list_hash', 'position', 'errored_ids'], key='phase'), {
+        "phase": phase,
+        "list_hash": list_hash,
+        "position": position,
+        "errored_ids": ','.join(str(game_id) for game_id in errored_ids),
+    })
+
+def commit():
+    global transaction
+    with metrics.timer('commit'):
+        transaction.commit()
+    transaction = connection.begin()
+
+def commit_chunk(phase, position, errored_ids):
+    # Write what is buffered and commit it together with the checkpoint, so a restarted run picks up from here
+    writer.flush()
+    save_checkpoint(phase, position, errored_ids)
+    commit()
+
+def process_games(phase, entries, process, limit=None, use_cache=True):
+    # entries are (rank position, game id) pairs in rank order and process(game_id, game) queues one GameRecord.
+    # Only the first limit entries after the checkpoint are processed, the checkpoint then ends at the last of them.
+    # Without use_cache the games are fetched from the API even when the response cache has a fresh copy.
+    # Returns how many games were processed and the ids that still could not be fetched after RETRY_ROUNDS retries
+    started = monotonic()
+    position, errored_ids = load_checkpoint(phase)
+    if position >= 0:
+        print(f"Resuming after rank position {position}, {len(errored_ids)} games to retry")
+    pending = [(entry_position, game_id) for entry_position, game_id in entries if entry_position > position][:limit]
+    print(f"Length of list: {len(pending)}")
+    processed = 0
+
+    for attempt in range(RETRY_ROUNDS + 1):
+        if attempt > 0:
+            if not errored_ids:
+                break
+            print()
+            print(f"Retrying {len(errored_ids)} games that could not be fetched")
+            pending = [(position, game_id) for game_id in errored_ids]
+            errored_ids = []
+
+        pending_ids = [game_id for _, game_id in pending]
+        if args.shards > 1:
+            fetched_games = fetch_sharded(pending_ids, args.shards, use_cache)
+        else:
+            fetched_games = fetch_all(pending_ids, use_cache)
+        progress = Progress(len(pending))
+        for index, ((entry_position, _), (game_id, game)) in enumerate(zip(pending, fetched_games)):
+            position = entry_position
+            if game is None:
+                metrics.count('games_errored', phase=phase)
+                errored_ids.append(game_id)
+            elif process(game_id, game):
+                metrics.count('games_processed', phase=phase)
+                processed += 1
+                if writer.game_done(game_id):
+                    # While retrying, the games that are still waiting in the queue have to be retried after a restart too
+                    waiting = [waiting_id for _, waiting_id in pending[index + 1:]] if attempt > 0 else []
+                    commit_chunk(phase, position, errored_ids + waiting)
+
+            progress.update(index + 1)
+
+        commit_chunk(phase, position, errored_ids)
 
     print()
+    metrics.add_time(f"phase_{phase}", monotonic() - started)
+    return processed, errored_ids
+
+
+def game_ids(ids=None):
+    # The ids of the games in the database, or of those of ids that are in it
+    if ids is None:
+        return {row[0] for row in connection.execute(text("SELECT id FROM board_game"))}
+    select_query = text("SELECT id FROM board_game WHERE id IN :ids").bindparams(bindparam("ids", expanding=True))
+    return {row[0] for row in connection.execute(select_query, {"ids": ids})} if ids else set()
+
+def load_fingerprints(ids=None):
+    # Fingerprints of the stats and of the record each game had when it was last written, for every game or only ids
+    select_query = "SELECT id, stats_hash, record_hash FROM board_game_fingerprint"
+    if ids is None:
+        rows = connection.execute(text(select_query))
+    elif ids:
+        rows = connection.execute(text(f"{select_query} WHERE id IN :ids").bindparams(bindparam("ids", expanding=True)), {"ids": ids})
+    else:
+        rows = []
+    return {row[0]: (row[1], row[2]) for row in rows}
+
+def load_ranked_list():
+    # The ids of boardgames_ranks.csv in rank order and a fingerprint of the stats of every game
+    global ranked_list, stats_hashes, list_hash
+    import pandas as pd
+    with metrics.timer('load_ranks'):
+        ranked_list, stats_list = load_ranks('boardgames_ranks.csv')
+    stats_hashes = dict(zip(ranked_list.tolist(), (format(stats_hash, '016x') for stats_hash in stats_list.tolist())))
+    # Checkpoints only apply to a run over the same list of games
+    list_hash = hashlib.blake2b(ranked_list.tobytes(), digest_size=8).hexdigest()
+
+    pd.DataFrame({'id': ranked_list}).to_csv('stripped_list.csv', index=False)
+
+def open_database():
+    global connection, transaction, lookups, writer
+    connection = engine.connect()
+    transaction = connection.begin()
+
+    # Load the publishers, honors, mechanics and categories once for the whole run
+    lookups = {table: LookupTable(connection, table) for table, _, _ in DIMENSIONS}
+    writer = BulkWriter(connection)
+
+    create_query = text("""
+        CREATE TABLE IF NOT EXISTS board_game_fingerprint (
+            id INT PRIMARY KEY,
+            stats_hash CHAR(16),
+            record_hash CHAR(16)
+        )
+    """)
+    connection.execute(create_query)
+
+    # How far each phase got, so a run that failed can be restarted where it stopped
+    create_query = text("""
+        CREATE TABLE IF NOT EXISTS ingest_checkpoint (
+            phase VARCHAR(16) PRIMARY KEY,
+            list_hash CHAR(16),
+            position INT,
+            errored_ids MEDIUMTEXT
+        )
+    """)
+    connection.execute(create_query)
+    commit()
+
+def ingest_new(ids=None, limit=None):
+    print("Adding new games")
+    if ids is None:
+        import numpy as np
+        # Games that are not in the database yet are fetched in the background, in rank order, while they are written.
+        # Positions in the ranked list are what the checkpoint of a phase counts
+        new_positions = np.flatnonzero(~np.isin(ranked_list, list(game_ids())))
+        entries = zip(new_positions.tolist(), ranked_list[new_positions].tolist())
+    else:
+        existing_ids = game_ids(ids)
+        entries = [(position, game_id) for position, game_id in enumerate(ids) if game_id not in existing_ids]
+
+    # Games named with --ids are always fetched from the API
+    new_games, errored_ids = process_games('new', entries, add_game, limit, use_cache=ids is None)
     print(f"New games that were added {new_games}")
     print(f"Number of games that we could not get info for: {len(errored_ids)}")
-    print("---------------------------------------------------------------")
-    print("Updating all the boardgames that have moved up in rank")
-
-    select_query = text("""
-        SELECT board_game.id
-        FROM board_game
-        INNER JOIN game_rank
-        ON board_game.id = game_rank.board_game_id
-        WHERE board_game.old_rank IS NOT NULL
-        AND board_game.old_rank < game_rank.game_rank;
-    """)
-    with engine.connect() as connect:
-        result = connect.execute(select_query)
-        board_game_ids = [row[0] for row in result]  # Extracting the first element from each tuple
-
-    total_items = len(board_game_ids)
-    print(f"Length of list: {total_items}")
-    last_printed_progress = 0
-    update = 1
-    errored_ids = []
-
-    for id in board_game_ids:
-        # Assuming board_game is a tuple and the id is the first element
-        url = f"https://api.geekdo.com/xmlapi/boardgame/{id}?&stats=1"
-        response = fetch_data(url)
-        
-        if response is None:
-            errored_ids.append(row['id'])
-            continue
-        
-        else:
-            try:    
-                root = ET.fromstring(response)
-                boardgame = root.find('boardgame')
-
-                # Get the data from the API
-                name = find_text(boardgame, 'name[@primary="true"]')
-                year_published = find_text(boardgame, 'yearpublished')
-                min_players = find_text(boardgame, 'minplayers')
-                max_players = find_text(boardgame, 'maxplayers')
-                age = find_text(boardgame, 'age')
-                average_weight = find_text(boardgame, 'statistics/ratings/averageweight')
-                playing_time = find_text(boardgame, 'playingtime')
-                min_playing_time = find_text(boardgame, 'minplaytime')
-                max_playing_time = find_text(boardgame, 'maxplaytime')
-                full_description = find_text(boardgame, 'description')
-                thumbnail = find_text(boardgame, 'thumbnail')
-                image = find_text(boardgame, 'image')
-                subdomain = find_text(boardgame, 'boardgamesubdomain')
-                average = find_text(boardgame, 'statistics/ratings/average')
-                bayes_average = find_text(boardgame, 'statistics/ratings/bayesaverage')
-                users_rated = find_text(boardgame, 'statistics/ratings/usersrated')
-                
-                # Update the board_game table
-                update_board_game_query = text("""
-                UPDATE board_game
-                SET name = :name,
-                    year_published = :year_published,
-                    min_players = :min_players,
-                    max_players = :max_players,
-                    age = :age,
-                    average_weight = :average_weight,
-                    playing_time = :playing_time,
-                    min_playing_time = :min_playing_time,
-                    max_playing_time = :max_playing_time,
-                    thumbnail = :thumbnail,
-                    image = :image,
-                    sub_domain = :subdomain,
-                    average = :average,
-                    bayes_average = :bayes_average,
-                    users_rated = :users_rated
-                WHERE id = :id
-                """)
-                connection.execute(update_board_game_query, {
-                    "id": id,
-                    "name": name,
-                    "year_published": year_published,
-                    "min_players": min_players,
-                    "max_players": max_players,
-                    "age": age,
-                    "average_weight": average_weight,
-                    "playing_time": playing_time,
-                    "min_playing_time": min_playing_time,
-                    "max_playing_time": max_playing_time,
-                    "thumbnail": thumbnail,
-                    "image": image,
-                    "subdomain": subdomain,
-                    "average": average,
-                    "bayes_average": bayes_average,
-                    "users_rated": users_rated,
-                })
-
-                # Update or insert full_description in board_game_description table
-                if full_description:
-                    if len(full_description) > 8000:
-                            full_description = full_description[:8000]  # Truncate the description to 8000 characters
-
-                    insert_description_query = text("""
-                        INSERT INTO board_game_description (id, full_description)
-                        VALUES (:id, :full_description)
-                        ON DUPLICATE KEY UPDATE full_description = :full_description
-                    """)
-                    connection.execute(insert_description_query, {
-                        "id": id,
-                        "full_description": full_description
-                    })
-
-
-                # For honors
-                honors = [honor.text for honor in boardgame.findall('boardgamehonor')]
-                for honor in honors:
-                    select_query = text("SELECT * FROM honors WHERE name = :val1")
-                    result = connection.execute(select_query, {"val1": honor})
-                    honor_row = result.fetchone()
-                    if honor_row is None:
-                        insert_query = text("INSERT INTO honors (name) VALUES (:val1)")
-                        connection.execute(insert_query, {"val1": honor})
-                        honor_id = connection.execute(text("SELECT LAST_INSERT_ID()")).fetchone()[0]
-                    else:
-                        honor_id = honor_row[0]
-
-                    # Check if the record already exists in the board_game_has_honors table
-                    select_query = text("SELECT * FROM board_game_has_honors WHERE board_game_id = :val1 AND honor_id = :val2")
-                    result = connection.execute(select_query, {"val1": id, "val2": honor_id})
-                    if result.rowcount == 0:
-                        insert_query = text("INSERT INTO board_game_has_honors (board_game_id, honor_id) VALUES (:val1, :val2)")
-                        connection.execute(insert_query, {"val1": id, "val2": honor_id})
-
-                # For mechanics
-                mechanics = [mechanic.text for mechanic in boardgame.findall('boardgamemechanic')]
-                for mechanic in mechanics:
-                    select_query = text("SELECT * FROM mechanics WHERE name = :val1")
-                    result = connection.execute(select_query, {"val1": mechanic})
-                    mechanic_row = result.fetchone()
-                    if mechanic_row is None:
-                        insert_query = text("INSERT INTO mechanics (name) VALUES (:val1)")
-                        connection.execute(insert_query, {"val1": mechanic})
-                        mechanic_id = connection.execute(text("SELECT LAST_INSERT_ID()")).fetchone()[0]
-                    else:
-                        mechanic_id = mechanic_row[0]
-
-                    # Check if the record already exists in the board_game_has_mechanics table
-                    select_query = text("SELECT * FROM board_game_has_mechanics WHERE board_game_id = :val1 AND mechanic_id = :val2")
-                    result = connection.execute(select_query, {"val1": id, "val2": mechanic_id})
-                    if result.rowcount == 0:
-                        insert_query = text("INSERT INTO board_game_has_mechanics (board_game_id, mechanic_id) VALUES (:val1, :val2)")
-                        connection.execute(insert_query, {"val1": id, "val2": mechanic_id})
-
-                # For categories
-                categories = [category.text for category in boardgame.findall('boardgamecategory')]
-                for category in categories:
-                    select_query = text("SELECT * FROM categories WHERE name = :val1")
-                    result = connection.execute(select_query, {"val1": category})
-                    category_row = result.fetchone()
-                    if category_row is None:
-                        insert_query = text("INSERT INTO categories (name) VALUES (:val1)")
-                        connection.execute(insert_query, {"val1": category})
-                        category_id = connection.execute(text("SELECT LAST_INSERT_ID()")).fetchone()[0]
-                    else:
-                        category_id = category_row[0]
-
-                    # Check if the record already exists in the board_game_has_categories table
-                    select_query = text("SELECT * FROM board_game_has_categories WHERE board_game_id = :val1 AND category_id = :val2")
-                    result = connection.execute(select_query, {"val1": id, "val2": category_id})
-                    if result.rowcount == 0:
-                        insert_query = text("INSERT INTO board_game_has_categories (board_game_id, category_id) VALUES (:val1, :val2)")
-                        connection.execute(insert_query, {"val1": id, "val2": category_id})
-            except ET.ParseError as e:
-                # Catch the ParseError, log it, and continue with the next game
-                print(f"Error parsing XML for game ID {row['id']}: {e}")
-                errored_ids.append(row['id'])
-                continue  # Skip to the next game
-
-            print_progress_bar(update, total_items)
-            update += 1
+    return new_games
+
+def rank_games():
+    import numpy as np
+    print("Adjusting ranks")
+    # Every game that is in the database gets a rank, games that could not be added are skipped
+    ranked_ids = ranked_list[np.isin(ranked_list, list(game_ids()))].tolist()
+    with metrics.timer('phase_ranks'):
+        sync_ranks(ranked_ids)
+    commit()
+    print(f"Ranked {len(ranked_ids)} games")
+
+def refresh_movers(ids=None, limit=None):
+    global fingerprints
+    print("Updating all the boardgames whose stats changed")
+    # Read now rather than at the start, so the games that were just added count as up to date
+    fingerprints = load_fingerprints(ids)
+
+    if ids is not None:
+        # The given games are fetched whether their stats changed or not
+        existing_ids = game_ids(ids)
+        refresh_entries = [(position, game_id) for position, game_id in enumerate(ids) if game_id in existing_ids]
+    else:
+        import numpy as np
+        # Games written before fingerprints existed fall back to the old rule: refresh the ones that moved up in rank
+        select_query = text("""
+            SELECT board_game.id
+            FROM board_game
+            INNER JOIN game_rank
+            ON board_game.id = game_rank.board_game_id
+            WHERE board_game.old_rank IS NOT NULL
+            AND board_game.old_rank < game_rank.game_rank;
+        """)
+        with engine.connect() as connect:
+            result = connect.execute(select_query)
+            moved_ids = {row[0] for row in result}  # Extracting the first element from each tuple
+
+        ranked_positions = np.flatnonzero(np.isin(ranked_list, list(game_ids())))
+        refresh_entries = []
+        for position, id in zip(ranked_positions.tolist(), ranked_list[ranked_positions].tolist()):
+            if id in fingerprints:
+                if fingerprints[id][0] != stats_hashes[id]:
+                    refresh_entries.append((position, id))
+            elif id in moved_ids:
+                refresh_entries.append((position, id))
+            else:
+                # Remember the current stats, so from the next run on this game is only fetched once they change
+                writer.add('board_game_fingerprint', {"id": id, "stats_hash": stats_hashes[id], "record_hash": None})
 
+    # A cached copy from before the stats changed would be written with the new stats fingerprint and the
+    # change would never be fetched, so refreshed games always come from the API
+    _, errored_ids = process_games('refresh', refresh_entries, refresh_game, limit, use_cache=False)
     print(f"Number of games that we could not get info for: {len(errored_ids)}")
 
-
-    print("---------------------------------------------------------------")
+def prune():
     print("Deleting games that are no longer on the database")
 
     delete_query = text("""
@@ -461,14 +891,107 @@ try:
             id NOT IN (SELECT board_game_id FROM game_rank);
     """)
 
-    connection.execute(delete_query)
+    with metrics.timer('phase_prune'):
+        connection.execute(delete_query)
+        connection.execute(text("DELETE FROM board_game_fingerprint WHERE id NOT IN (SELECT id FROM board_game)"))
+    commit()
     print("Deleted")
-    
-    transaction.commit()
-
-except Exception as e:
-    transaction.rollback()
-    print(f"An error occurred: {e}")
-    traceback.print_exc()
-finally:
-    connection.close()  # Ensure the connection is closed
+
+def export_tables():
+    from dashboard_exports import build_exports
+    from game_similarity import build_similar
+
+    print("Building the dashboard tables")
+    with metrics.timer('phase_export'):
+        exported = build_exports(engine, EXPORT_DIR, EXPORT_TOP_N)
+    for export, rows in exported.items():
+        metrics.count('export_rows', rows, table=export)
+        print(f"{export}: {rows} rows")
+
+    if SIMILAR_TOP_K:
+        print("---------------------------------------------------------------")
+        print("Finding similar games")
+        with metrics.timer('phase_similar'):
+            updated = build_similar(engine, SIMILAR_TOP_K)
+        metrics.count('similar_games_updated', updated)
+        print(f"Games with new similar games: {updated}")
+
+def run_all(limit=None):
+    new_games = ingest_new(limit=limit)
+
+    print("---------------------------------------------------------------")
+    # An earlier run over the same list that failed later on has already ranked the games, unless this run added
+    # games that failed back then, those need a rank or prune would delete them.
+    # Only this checks and records the ranks checkpoint, rank on its own always ranks again
+    if new_games or load_checkpoint('ranks')[0] < 0:
+        rank_games()
+        save_checkpoint('ranks', len(ranked_list), [])
+        commit()
+
+    print("---------------------------------------------------------------")
+    refresh_movers(limit=limit)
+
+    print("---------------------------------------------------------------")
+    prune()
+
+    # The run is complete, the next one starts from the beginning
+    connection.execute(text("DELETE FROM ingest_checkpoint"))
+    commit()
+
+    print("---------------------------------------------------------------")
+    export_tables()
+
+
+# Set by load_ranked_list, a run with --ids leaves them empty
+ranked_list = None
+stats_hashes = {}
+list_hash = None
+fingerprints = {}
+
+def main():
+    global args, engine, rate_limiter, response_cache, offline
+    args = parse_args()
+    offline = args.offline
+    engine = create_engine()
+    rate_limiter = RateLimiter(REQUESTS_PER_SECOND, burst=FETCH_WORKERS)
+    response_cache = ResponseCache(RESPONSE_CACHE, CACHE_TTL, CACHE_MAX_BYTES) if RESPONSE_CACHE else None
+
+    if args.ids is None and args.command in ('all', 'ingest-new', 'rank', 'refresh-movers'):
+        load_ranked_list()
+
+    open_database()
+    try:
+        if args.command == 'all':
+            run_all(args.limit)
+        elif args.command == 'ingest-new':
+            ingest_new(args.ids, args.limit)
+        elif args.command == 'rank':
+            rank_games()
+        elif args.command == 'refresh-movers':
+            refresh_movers(args.ids, args.limit)
+        elif args.command == 'prune':
+            prune()
+        elif args.command == 'export':
+            export_tables()
+
+    except Exception as e:
+        metrics.count('run_errors')
+        if transaction.is_active:
+            transaction.rollback()
+        print(f"An error occurred: {e}")
+        print("Everything up to the last checkpoint was saved, run the script again to continue from there")
+        traceback.print_exc()
+    finally:
+        connection.close()  # Ensure the connection is closed
+        if response_cache:
+            response_cache.close()
+
+        if METRICS_FILE:
+            metrics.write_json(METRICS_FILE)
+            print(f"Metrics written to {METRICS_FILE}")
+        if PROMETHEUS_FILE:
+            metrics.write_prometheus(PROMETHEUS_FILE)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+import json
+import os
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import timedelta
+from time import monotonic, time
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        # (upper bound, observations at or below it) pairs, the last bound is +Inf
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield str(bound), total
+
+
+class Metrics:
+    # Counters, per stage timers and histograms for one run, shared by the fetch workers and the writer.
+    # Every metric can carry labels, e.g. count('db_rows', 500, table='board_game')
+    def __init__(self, prefix='bgg_pipeline'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.started = time()
+        self.counters = {}
+        self.timers = {}
+        self.histograms = {}
+
+    def count(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            timer = self.timers.setdefault(stage, [0.0, 0])
+            timer[0] += seconds
+            timer[1] += 1
+
+    @contextmanager
+    def timer(self, stage):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.add_time(stage, monotonic() - start)
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.histograms.setdefault(key, Histogram(buckets)).observe(value)
+
+    def snapshot(self):
+        # Everything recorded so far, to be merged into the metrics of another process
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'timers': {stage: list(timer) for stage, timer in self.timers.items()},
+                'histograms': dict(self.histograms),
+            }
+
+    def merge(self, snapshot):
+        with self.lock:
+            for key, value in snapshot['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for stage, (seconds, count) in snapshot['timers'].items():
+                timer = self.timers.setdefault(stage, [0.0, 0])
+                timer[0] += seconds
+                timer[1] += count
+            for key, other in snapshot['histograms'].items():
+                histogram = self.histograms.setdefault(key, Histogram(other.buckets))
+                histogram.counts = [count + other_count for count, other_count in zip(histogram.counts, other.counts)]
+                histogram.sum += other.sum
+                histogram.count += other.count
+
+    def summary(self):
+        with self.lock:
+            counters = {}
+            for (name, labels), value in sorted(self.counters.items()):
+                if labels:
+                    counters.setdefault(name, {})[format_labels(labels)] = value
+                else:
+                    counters[name] = value
+
+            histograms = {}
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                histograms.setdefault(name, {})[format_labels(labels) or 'all'] = {
+                    'count': histogram.count,
+                    'sum': round(histogram.sum, 6),
+                    'buckets': dict(histogram.cumulative()),
+                }
+
+            return {
+                'started': self.started,
+                'duration_seconds': round(time() - self.started, 3),
+                'stages': {stage: {'seconds': round(seconds, 6), 'count': count} for stage, (seconds, count) in sorted(self.timers.items())},
+                'counters': counters,
+                'histograms': histograms,
+            }
+
+    def write_json(self, path):
+        write_atomic(path, json.dumps(self.summary(), indent=2) + '\n')
+
+    def write_prometheus(self, path):
+        # Text exposition format, e.g. for the textfile collector of the node exporter
+        lines = []
+        with self.lock:
+            lines.append(f"# TYPE {self.prefix}_duration_seconds gauge")
+            lines.append(f"{self.prefix}_duration_seconds {time() - self.started}")
+
+            lines.append(f"# TYPE {self.prefix}_stage_seconds_total counter")
+            for stage, (seconds, _) in sorted(self.timers.items()):
+                lines.append(f'{self.prefix}_stage_seconds_total{{stage="{stage}"}} {seconds}')
+
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                metric = f"{self.prefix}_{name}_total"
+                if metric not in typed:
+                    lines.append(f"# TYPE {metric} counter")
+                    typed.add(metric)
+                lines.append(f"{metric}{prometheus_labels(labels)} {value}")
+
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                metric = f"{self.prefix}_{name}"
+                if metric not in typed:
+                    lines.append(f"# TYPE {metric} histogram")
+                    typed.add(metric)
+                for bound, count in histogram.cumulative():
+                    lines.append(f"{metric}_bucket{prometheus_labels(labels + (('le', bound),))} {count}")
+                lines.append(f"{metric}_sum{prometheus_labels(labels)} {histogram.sum}")
+                lines.append(f"{metric}_count{prometheus_labels(labels)} {histogram.count}")
+
+        write_atomic(path, '\n'.join(lines) + '\n')
+
+
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def format_labels(labels):
+    return ','.join(f"{name}={value}" for name, value in labels)
+
+
+def prometheus_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+def write_atomic(path, content):
+    # Readers never see a half written file
+    with open(f"{path}.tmp", 'w') as file:
+        file.write(content)
+    os.replace(f"{path}.tmp", path)
+
+
+class Progress:
+    # Progress bar with games/sec and an ETA, redrawn at most every interval seconds instead of after every game
+    def __init__(self, total, interval=0.5, bar_length=50):
+        self.total = total
+        self.interval = interval
+        self.bar_length = bar_length
+        self.started = monotonic()
+        self.drawn = 0
+
+    def update(self, current):
+        now = monotonic()
+        if current < self.total and now - self.drawn < self.interval:
+            return
+        self.drawn = now
+
+        progress = current / self.total if self.total else 1
+        block = int(self.bar_length * progress)
+        bar = "#" * block + "-" * (self.bar_length - block)
+        elapsed = now - self.started
+        rate = current / elapsed if elapsed > 0 else 0
+        eta = timedelta(seconds=round((self.total - current) / rate)) if rate > 0 else '?'
+        print(f"\r[{bar}] {progress * 100:.2f}% {current}/{self.total} {rate:.1f} games/s ETA {eta}   ", end='', flush=True)
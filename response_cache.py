@@ -0,0 +1,112 @@
+import sqlite3
+import threading
+import zlib
+from collections import namedtuple
+from time import time
+
+CacheEntry = namedtuple('CacheEntry', ['body', 'etag', 'last_modified', 'fresh'])
+
+
+class ResponseCache:
+    # On-disk cache of the XML the API returned for each game, stored compressed in one SQLite file.
+    # Entries expire after ttl seconds but are kept so they can be revalidated with ETag/Last-Modified,
+    # and the least recently used entries are evicted once the cache grows past max_bytes.
+    # Several processes can share the file. Only one of them should keep the index and evict, the others pass
+    # index=False, read entries straight from the file and leave eviction to the next reload of the one with the index
+    def __init__(self, path, ttl=12 * 60 * 60, max_bytes=1024 ** 3, index=True):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # Wait for the other processes' writes rather than fail with "database is locked"
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                id INTEGER PRIMARY KEY,
+                body BLOB NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+
+        # Access times of the entries read since the cache was opened, written back when it is closed
+        self.accessed = {}
+        self.index = None
+        if index:
+            self.reload()
+
+    def reload(self):
+        # id -> [size, accessed_at] is kept in memory so lookups and eviction never scan the table.
+        # Reloading picks up what other processes wrote, and evicts if that took the cache past max_bytes
+        with self.lock:
+            rows = self.db.execute("SELECT id, length(body), accessed_at FROM responses")
+            self.index = {game_id: [size, self.accessed.get(game_id, accessed_at)] for game_id, size, accessed_at in rows}
+            self.size = sum(size for size, _ in self.index.values())
+            if self.size > self.max_bytes:
+                self.evict()
+                self.db.commit()
+
+    def get(self, game_id):
+        with self.lock:
+            if self.index is not None and game_id not in self.index:
+                return None
+            query = "SELECT body, etag, last_modified, fetched_at FROM responses WHERE id = ?"
+            row = self.db.execute(query, (game_id,)).fetchone()
+            if row is None:
+                return None
+            body, etag, last_modified, fetched_at = row
+            self.accessed[game_id] = time()
+            if self.index is not None:
+                self.index[game_id][1] = self.accessed[game_id]
+
+        return CacheEntry(zlib.decompress(body), etag, last_modified, time() - fetched_at < self.ttl)
+
+    def put_many(self, bodies, etag=None, last_modified=None):
+        # bodies is a dict of game id -> XML of that game, all taken from the same response
+        now = time()
+        rows = [(game_id, zlib.compress(body), etag, last_modified, now, now) for game_id, body in bodies.items()]
+
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)", rows)
+            if self.index is None:
+                self.db.commit()
+                return
+            for game_id, body, _, _, _, _ in rows:
+                if game_id in self.index:
+                    self.size -= self.index[game_id][0]
+                self.index[game_id] = [len(body), now]
+                self.size += len(body)
+
+            if self.size > self.max_bytes:
+                self.evict()
+            self.db.commit()
+
+    def revalidated(self, ids):
+        # The API answered 304 Not Modified, so the cached copies are good for another ttl
+        now = time()
+        with self.lock:
+            self.db.executemany("UPDATE responses SET fetched_at = ? WHERE id = ?", [(now, game_id) for game_id in ids])
+            self.db.commit()
+
+    def evict(self):
+        # Drop the least recently used entries until the cache is back under 90% of max_bytes,
+        # so a full cache does not evict again on every write. Call with the lock held
+        evicted = []
+        for game_id, (size, _) in sorted(self.index.items(), key=lambda item: item[1][1]):
+            if self.size <= self.max_bytes * 0.9:
+                break
+            evicted.append((game_id,))
+            self.size -= size
+            del self.index[game_id]
+
+        self.db.executemany("DELETE FROM responses WHERE id = ?", evicted)
+
+    def close(self):
+        with self.lock:
+            accessed = [(accessed_at, game_id) for game_id, accessed_at in self.accessed.items()]
+            self.db.executemany("UPDATE responses SET accessed_at = ? WHERE id = ?", accessed)
+            self.db.commit()
+            self.db.close()